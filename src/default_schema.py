@@ -239,16 +239,38 @@ class AggregateData:
             row = database.execSQL(conn, [trafficInsert], doCommit=True, fetchId=True)
             return row[0] # only a single row due to fetchone()
 
+    @staticmethod
+    def getIntervalIDs(conn, typeName, intervalEnds, intervalLength):
+        """retrieve the ids of the given intervals, inserting the missing ones,
+        and return a map from interval end to id"""
+        intervalTable = AggregateData.getSchema(typeName)[0]
+        intervalEnds = list(intervalEnds)
+        database.execSQL(conn, """
+                INSERT INTO %s(%s) SELECT e FROM unnest(%%s) AS ends(e)
+                WHERE NOT EXISTS (SELECT 1 FROM %s WHERE %s = e)""" % (
+            intervalTable,
+            Tables.traffic.traffic_time,
+            intervalTable,
+            Tables.traffic.traffic_time), doCommit=True, params=(intervalEnds,))
+        # one id per interval end in the given order
+        rows = database.execSQL(conn, """
+                SELECT (SELECT %s FROM %s WHERE %s = e LIMIT 1)
+                FROM unnest(%%s) WITH ORDINALITY AS ends(e, i) ORDER BY i""" % (
+            Tables.traffic.traffic_id,
+            intervalTable,
+            Tables.traffic.traffic_time), params=(intervalEnds,))
+        return dict(zip(intervalEnds, [row[0] for row in rows]))
+
     @staticmethod
     def insertData(conn, typeName, values):
         if len(values) == 0:
             return
         intervalTable, dataTable, q_column, v_column = AggregateData.getSchema(typeName)
-        database.execSQL(conn, "DELETE FROM %s WHERE %s = %s"  % (dataTable, intervalTable.traffic_id, values[0][0]))
-        command = "INSERT INTO %s(%s, edge_id, %s, %s, quality) VALUES(%s)" % (
-                  dataTable, intervalTable.traffic_id, q_column, v_column,
-                  ", ".join(["%s"] * len(values[0])))
-        database.execSQL(conn, [command], doCommit=True, manySet=values)
+        # the values may belong to several intervals (see aggregateData.flushAggregated)
+        trafficIDs = sorted(set(str(v[0]) for v in values))
+        database.execSQL(conn, "DELETE FROM %s WHERE %s IN (%s)"  % (dataTable, intervalTable.traffic_id, ",".join(trafficIDs)))
+        columns = [intervalTable.traffic_id, "edge_id", q_column, v_column, "quality"]
+        database.copyRows(conn, dataTable, columns, values)
 
     @staticmethod
     def getEmissionSchema(typeName):
@@ -260,10 +282,8 @@ class AggregateData:
             return
         intervalTable, dataTable, emissionColumns = AggregateData.getEmissionSchema(typeName)
         database.execSQL(conn, "DELETE FROM %s WHERE %s = %s"  % (dataTable, intervalTable.traffic_id, values[0][0]))
-        command = "INSERT INTO %s(%s, edge_id, %s, quality) VALUES(%s)" % (
-                  dataTable, intervalTable.traffic_id, emissionColumns,
-                  ", ".join(["%s"] * len(values[0])))
-        database.execSQL(conn, [command], doCommit=True, manySet=values)
+        columns = [intervalTable.traffic_id, "edge_id"] + emissionColumns.split(", ") + ["quality"]
+        database.copyRows(conn, dataTable, columns, values)
 
     @staticmethod
     def getComparisonData(conn, typeName, time):
@@ -336,34 +356,33 @@ class GenerateSimulationInput:
 
     @staticmethod
     def getTypedTrafficValues(conn, types, begin, end, qualityThreshold, intervalLength, timeline):
-        """return rows of [edge_id, time, interval_length, flow_per_hour, speed_km_per_h, quality, type]"""
+        """return an iterator over rows of [edge_id, time, interval_length, flow_per_hour, speed_km_per_h, quality, type]
+        sorted by edge and time, rows of the same time in the order of the given types"""
         if timeline: 
             raise Exception("timeline not support for dbSchema '%s'" % __file__)
-        result = []
         reverseEdgeMap = reversedMap(AggregateData.getSimulationEdgeMap(conn))
-        for type in types:
+        queries = []
+        for typeIndex, type in enumerate(types):
             intervalTable, dataTable, q_column, v_column = AggregateData.getSchema(type)
-            query = """
-                SELECT edge_id, %s, %s, %s, a.quality
+            queries.append("""
+                SELECT edge_id, %s, %s, %s, a.quality, %s
                 FROM %s t, %s a WHERE true
                 AND a.%s = t.%s 
                 AND %s > '%s' 
                 AND %s <= '%s' 
                 AND a.quality > %s
-                ORDER BY %s, edge_id
                 """ % (Tables.traffic.traffic_time,
-                        q_column, v_column,
+                        q_column, v_column, typeIndex,
                         intervalTable, dataTable,
                         Tables.traffic.traffic_id,
                         Tables.traffic.traffic_id,
                         Tables.traffic.traffic_time, begin, 
                         Tables.traffic.traffic_time, end, 
-                        qualityThreshold,
-                        Tables.traffic.traffic_time)
-            #print query
-            rows = database.execSQL(conn, query)
-            result += [(reverseEdgeMap.get(e), t, intervalLength, q, v, qual, type) for e,t,q,v,qual in rows]
-        return result
+                        qualityThreshold))
+        query = "UNION ALL".join(queries) + "ORDER BY 1, 2, 6"
+        #print query
+        rows = database.execSQLIter(conn, query, "typed_traffic_rows")
+        return ((reverseEdgeMap.get(e), t, intervalLength, q, v, qual, types[typeIndex]) for e, t, q, v, qual, typeIndex in rows)
 
 
     @staticmethod
@@ -22,10 +22,13 @@ from .database import as_time
 from .tools import reversedMap
 
 def insertAggregated(conn, typeName, detReader, intervalEnd, intervalLength, isSimulation=False, 
-                     doClose=False, flowScale=1.0, expectedEntryCount=0):
+                     doClose=False, flowScale=1.0, expectedEntryCount=0, edgeMap=None, pending=None):
     """Insert aggregated data into the database. The data is read from the
        given DetectorReader. If it is simulation data the edge ids are
-       taken as Navteq IDs instead of database road_section IDs and scenarios are taken into account."""
+       taken as Navteq IDs instead of database road_section IDs and scenarios are taken into account.
+       The simulation edge map is retrieved from the database if not given.
+       If pending is a list, the writes are appended to it for a later flushAggregated
+       which also resolves the traffic ids of all intervals at once."""
     AggregateData = setting.dbSchema.AggregateData
     if conn == None:
         conn = database.createOutputConnection()
@@ -33,11 +36,12 @@ def insertAggregated(conn, typeName, detReader, intervalEnd, intervalLength, isS
     trafficIndex = None
     values = {}
     intervalTable, dataTable, q_column, v_column = AggregateData.getSchema(typeName)
-    edgeMap = AggregateData.getSimulationEdgeMap(conn, True) if isSimulation else None
+    if isSimulation and edgeMap is None:
+        edgeMap = AggregateData.getSimulationEdgeMap(conn, True)
     # handle existing entry in traffic for the same type and time
     if isSimulation and setting.scenarioID:
         trafficIndex = AggregateData.getIntervalID(conn, typeName, intervalEnd, intervalLength, setting.scenarioID)
-    else:
+    elif pending is None:
         trafficIndex = AggregateData.getIntervalID(conn, typeName, intervalEnd, intervalLength)
     # process the detReader
     totalQuality = 0.
@@ -78,7 +82,7 @@ def insertAggregated(conn, typeName, detReader, intervalEnd, intervalLength, isS
             groupCount += len(groups)
             values[edge] = (flowSum, speedSum, qualitySum, coverageSum, entryCount, groupCount)
     insertRows = []
-    for edge, (flowSum, speedSum, qualitySum, coverageSum, entryCount, groupCount) in list(values.items()):
+    for edge, (flowSum, speedSum, qualitySum, coverageSum, entryCount, groupCount) in values.items():
         if entryCount > 0:
         #    if edge == 7047:
         #        print('BEFORE INSERT', flowSum, speedSum, qualitySum, coverageSum, entryCount)
@@ -132,15 +136,54 @@ def insertAggregated(conn, typeName, detReader, intervalEnd, intervalLength, isS
                   AggregateData.update_description(dataTable, typeName),
                   coverageSum / len(insertRows))))
         totalQuality /= len(insertRows)
-        updateQualityQuery = "UPDATE %s SET quality = %s WHERE %s = %s" % (
-                intervalTable,
-                totalQuality,
-                intervalTable.traffic_id,
-                trafficIndex)
-        database.execSQL(conn, [updateQualityQuery], True)
-        AggregateData.insertData(conn, typeName, insertRows)
+        if pending is not None:
+            pending.append((intervalEnd, intervalLength, trafficIndex, totalQuality, insertRows))
+        else:
+            database.execSQL(conn, [_updateQualityQuery(intervalTable, totalQuality, trafficIndex)], True)
+            AggregateData.insertData(conn, typeName, insertRows)
     if doClose:
-        conn.close()
+        database.closeDatabaseConnection(conn)
+
+
+def _updateQualityQuery(intervalTable, totalQuality, trafficIndex):
+    return "UPDATE %s SET quality = %s WHERE %s = %s" % (
+            intervalTable,
+            totalQuality,
+            intervalTable.traffic_id,
+            trafficIndex)
+
+
+def _getIntervalIDs(conn, typeName, intervalEnds, intervalLength):
+    """Returns a map from interval end to the id of the (possibly new) interval,
+       using the bulk lookup of the schema if it has one."""
+    AggregateData = setting.dbSchema.AggregateData
+    if hasattr(AggregateData, "getIntervalIDs"):
+        return AggregateData.getIntervalIDs(conn, typeName, intervalEnds, intervalLength)
+    return dict([(intervalEnd, AggregateData.getIntervalID(conn, typeName, intervalEnd, intervalLength))
+                 for intervalEnd in intervalEnds])
+
+
+def flushAggregated(conn, typeName, pending):
+    """Writes the data collected by insertAggregated calls with the given pending list.
+       The missing traffic ids are resolved together, followed by one statement for
+       the quality updates and one bulk insert."""
+    if pending:
+        intervalTable = setting.dbSchema.AggregateData.getSchema(typeName)[0]
+        missing = [entry for entry in pending if entry[2] is None]
+        trafficIDs = {}
+        if missing:
+            trafficIDs = _getIntervalIDs(conn, typeName, [entry[0] for entry in missing], missing[0][1])
+        updates = []
+        insertRows = []
+        for intervalEnd, intervalLength, trafficIndex, totalQuality, rows in pending:
+            if trafficIndex is None:
+                trafficIndex = trafficIDs[intervalEnd]
+                rows = [(trafficIndex,) + row[1:] for row in rows]
+            updates.append(_updateQualityQuery(intervalTable, totalQuality, trafficIndex))
+            insertRows += rows
+        database.execSQL(conn, updates, True)
+        setting.dbSchema.AggregateData.insertData(conn, typeName, insertRows)
+        del pending[:]
 
 
 def aggregateDetector(start, end, intervalLength, updateInterval):
@@ -262,7 +305,7 @@ def aggregateDetector(start, end, intervalLength, updateInterval):
     #    data = detReader.getDetector(d)
     #    print(d, data.totalFlow, data.avgSpeed, data.quality, data.coverage, data.entryCount)
     insert(nextInterval)
-    conn.close()
+    database.closeDatabaseConnection(conn)
 
 
 def _wait_if_trafficlight(row, waittime):
@@ -413,7 +456,7 @@ def aggregateFCD(start, end, period, intervalLength, tlsWait):
                          intervalLength,
                          expectedEntryCount=intervalLength.seconds/600)
         nextInterval += period
-    conn.close()
+    database.closeDatabaseConnection(conn)
 
 
 def generateComparison(outfile, time, types):
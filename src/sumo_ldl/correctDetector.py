@@ -14,7 +14,7 @@ Usually it is called from loop.py.
 """
 import sys
 import os
-import pickle, csv
+import csv
 from datetime import datetime, timedelta
 from collections import defaultdict
 
@@ -27,7 +27,7 @@ from . import setting, database
 from .setting import hasOption, getDetectorOption, getDetectorOptionBool, getDetectorOptionMinutes, getLoopOptionMinutes, getLoopOption, getLoopOptionBool, getOptionBool
 from .setting import dbSchema
 from .database import as_time, as_interval
-from .tools import roundToMinute, ROUND_DOWN, ROUND_UP
+from .tools import roundToMinute, loadEdges, ROUND_DOWN, ROUND_UP
 from .step import pythonStep
 from .evalDetector import Data, isDataError
 from . import extrapolation
@@ -152,16 +152,17 @@ def fixedData(origID, detectorID, date, qPKW, qLKW, vPKW, vLKW, errorCode):
     dat.vLKW = vLKW
     dat.decomposeErrorCode(errorCode, date)
     if not origID:
-        dat.fixed = set(["qPKW", "qLKW", "vPKW", "vLKW"])
+        for attr in Data.attrs:
+            dat.markFixed(attr)
     else:
         if isDataError(dat.errorPKW) and qPKW != None:
-            dat.fixed.add("qPKW")
+            dat.markFixed("qPKW")
         if dat.errorPKW > 0 and vPKW != None:
-            dat.fixed.add("vPKW")
+            dat.markFixed("vPKW")
         if isDataError(dat.errorLKW) and qLKW != None:
-            dat.fixed.add("qLKW")
+            dat.markFixed("qLKW")
         if dat.errorLKW > 0 and vLKW != None:
-            dat.fixed.add("vLKW")
+            dat.markFixed("vLKW")
     return dat
 
 def emptyData(detectorID, origID):
@@ -692,7 +693,7 @@ def correctDetector(isFirst, correctStart, correctEnd, forecastEnd,
     rows = dbSchema.CorrectDetector.get_measurements_for_interval(conn, correctStart, correctEnd, updateInterval, DETECTOR_FILTER)  #  changes needed for tests
     if not rows and getDetectorOptionBool("historic"):
         if not _GLOBALS.has_more_data_after(conn, correctEnd):
-            conn.close()
+            database.closeDatabaseConnection(conn)
             return False
     # we got raw data. lets start
     error_counts = identify_errors(rows, checkDoubling, hasLkw)
@@ -701,7 +702,7 @@ def correctDetector(isFirst, correctStart, correctEnd, forecastEnd,
     forecast_counts = fixGaps(correctEnd, forecastEnd, forecast=True)
     # update db
     num_written = write_corrected(conn, correctStart, hasLkw)
-    conn.close()
+    database.closeDatabaseConnection(conn)
     # reporting
     forecast_needed = (dateToIndex(forecastEnd) - dateToIndex(correctEnd)) * len(_GLOBALS.data)
     print(correction_summary(len(rows), error_counts, corrected_counts,
@@ -718,37 +719,38 @@ def main(isFirst, beginNewDay, loopDir, options):
     # init setting.edges
     if not setting.edges:
         region = getLoopOption("region")
-        root = os.path.abspath(os.path.join(loopDir, region))
-        edgePklFile = os.path.join(root, "infra", "edges.pkl")
-        if os.path.isfile(edgePklFile):
-            edgePkl = open(edgePklFile, 'rb')
-            setting.edges = pickle.load(edgePkl)
-            edgePkl.close()
+        infraDir = os.path.abspath(os.path.join(loopDir, region, "infra"))
+        if os.path.isfile(os.path.join(infraDir, "edges.pkl")):
+            setting.edges = loadEdges(infraDir)
         else:
-            setting.edges = []
+            setting.edges = frozenset()
     # init updateIntervals
     if setting.updateIntervals is None:
+        if getLoopOptionMinutes("aggregate") <= timedelta(0):
+            raise ValueError("Loop option 'aggregate' must be positive") # otherwise aggregation will not terminate
         conn = database.createDatabaseConnection()    
         query = "SELECT DISTINCT (%s) from %s " % (
                 dbSchema.Tables.induction_loop.loop_interval,
                 dbSchema.Tables.induction_loop)
-        available_intervals = [row[0] for row in database.execSQL(conn, query)]
-        conn.close()
+        available_intervals = frozenset(row[0] for row in database.execSQL(conn, query))
+        database.closeDatabaseConnection(conn)
         if setting.hasOption("Detector", "updateinterval"):
             setting.updateIntervals = []
+            value = setting.getDetectorOption("updateinterval")
             try:
                 # value should be a comma-separated list of minutes as float
-                for minutes in setting.getDetectorOption("updateinterval").split(','):
-                    seconds = float(minutes) * 60
-                    if seconds in available_intervals:
-                        setting.updateIntervals.append(seconds)
-                    else:
-                        print(("Warning: updateinterval %s does not exist in the database" % minutes))
-            except:
+                minuteList = [float(minutes) for minutes in value.split(',')]
+            except ValueError:
                 print(("Error:Could not parse value of Detector option 'updateinterval = %s' as a list of floats" % value))
                 return False
+            for minutes in minuteList:
+                seconds = minutes * 60
+                if seconds in available_intervals:
+                    setting.updateIntervals.append(seconds)
+                else:
+                    print(("Warning: updateinterval %s does not exist in the database" % minutes))
         else:
-            setting.updateIntervals = available_intervals
+            setting.updateIntervals = sorted(available_intervals)
         if len(setting.updateIntervals) == 0:
             print("Warning: Empty list of detector update intervals: skipping correction and aggregation of induction loop data")
         else:
@@ -769,7 +771,6 @@ def main(isFirst, beginNewDay, loopDir, options):
     aggregate = getLoopOptionMinutes("aggregate")
     aggStart = roundToMinute(correctStart, aggregate, ROUND_DOWN)
     aggEnd = roundToMinute(loopRawForecastEnd, aggregate, ROUND_UP)
-    assert(aggregate > timedelta(0)) # otherwise aggregation will not terminate
     beginTime = datetime.now()    
     print("""\
 -----------------------------------------------------------------------------
@@ -784,11 +785,12 @@ Data correction and aggregation from %s to %s
     # 1. Correcting detector data
     #if options.do_correction and setting.updateIntervals:
     if getDetectorOptionBool("doDetectorCorrection") and setting.updateIntervals:
+        interpolationWindow = getDetectorOptionMinutes("interpolationwindow")
+        evaluationInterval = getDetectorOptionMinutes("evaluationinterval")
         for updateInterval in setting.updateIntervals:
             result = pythonStep("Correcting detector data with updateInterval %s" % updateInterval, correctDetector,
                     (isFirst, correctStart, correctEnd, loopRawForecastEnd,
-                        getDetectorOptionMinutes("interpolationwindow"),
-                        getDetectorOptionMinutes("evaluationinterval"), updateInterval))
+                        interpolationWindow, evaluationInterval, updateInterval))
     else:
         result = True
     # 2. Aggregating detector data
@@ -827,12 +829,13 @@ Data correction and aggregation from %s to %s
             pythonStep("Aggregating visual data", correctVisual.aggregateVisual,
                        (aggVisualStart, aggVisualEnd, aggregateVisual))
     # 6. Data fusion
-    if getDetectorOptionBool("doFusion") and aggregate > timedelta(0):
+    doFusion = getDetectorOptionBool("doFusion")
+    if doFusion and aggregate > timedelta(0):
         pythonStep("Data fusion", fusion.fusion,
                    (aggStart, aggEnd, aggregate))
     # 7. Data extrapolation
     if forecastEnd != correctEnd:
-        sourceType = 'fusion' if getDetectorOptionBool("doFusion") else 'loop'
+        sourceType = 'fusion' if doFusion else 'loop'
         pythonStep("Data extrapolation", extrapolation.main,
                    (correctEnd, forecastEnd, aggregate, sourceType))
 
@@ -14,6 +14,8 @@ Corrects and aggregates traffic data from evaluated pictures
 from datetime import datetime, timedelta
 from collections import defaultdict
 
+import numpy
+
 from . import setting, database
 from .aggregateData import insertAggregated
 from .evalDetector import Data
@@ -25,43 +27,41 @@ def correctVisual(correctStart, correctEnd):
     Correct visual data values by checking for obvious errors.
     """ 
     error_counts = defaultdict(int)
-    conn = database.createDatabaseConnection()
+    conn = database.getConnection()
     rows = database.execSQL(conn, """
         SELECT visual_data_id, detection_time, vehicle_density, 0, average_speed, 0, edge_id
         FROM visual_data v
-        WHERE detection_time >= '%s' AND detection_time < '%s'""" % (correctStart, correctEnd))
+        WHERE detection_time >= %s AND detection_time < %s""", params=(correctStart, correctEnd))
     values = []
-    for row in rows:
-        data = Data(row[0], row[6], row[1], None, None, row[4], row[5])
-        vPKW = row[4]
-        if vPKW == 0:
-            vPKW = 50 / 3.6
-        if row[2] == None:
-            data.qPKW = 0
-        else:
-            data.qPKW = 3.6 * row[2] / vPKW
-        vLKW = row[5]
-        if vLKW == 0:
-            vLKW = 50 / 3.6
-        if row[3] == None:
-            data.qLKW = 0
-        else:
-            data.qLKW = 3.6 * row[3] / vLKW
-        data.check(timedelta(hours=1))
+    datas = []
+    if rows:
+        densities, densitiesLKW, speeds, speedsLKW = list(zip(*rows))[2:6]
+        # flows are derived from density and speed, assuming 50 km/h for standing traffic
+        flows = []
+        for density, speed in ((densities, speeds), (densitiesLKW, speedsLKW)):
+            density = numpy.array(density, dtype=float)
+            speed = numpy.array(speed, dtype=float)
+            speed[speed == 0] = 50 / 3.6
+            flows.append(numpy.where(numpy.isnan(density), 0, 3.6 * density / speed).tolist())
+        for row, qPKW, qLKW in zip(rows, *flows):
+            data = Data(row[0], row[6], row[1], qPKW, None, row[4], row[5])
+            data.qLKW = qLKW
+            data.check(timedelta(hours=1))
+            datas.append(data)
+    for data in datas:
         # update error counts
         for a in Data.attrs:
             if getattr(data, a) is None:
                 error_counts[a] += 1
-        v = data.toValues(row[1])
+        v = data.toRow(data.origDate)
         if v:
             values.append(v)
         data.toBeWritten = False
     if values:
         command = """INSERT INTO corrected_visual_data(original_data_id, edge_id, data_time,
                                                        q_pkw, q_lkw, v_pkw, v_lkw,
-                                                       quality) VALUES """ + (",".join(values))
-        database.execSQL(conn, command, True)
-    conn.close()
+                                                       quality) VALUES %s"""
+        database.execSQL(conn, command, True, manySet=values, useValues=True)
     summary = "db-lines read: %s, written %s" % (len(rows), len(values))
     header = 'attr\terrors'
     entries = ['\t'.join(map(str, [a, error_counts[a]])) for a in Data.attrs]
@@ -70,17 +70,19 @@ def correctVisual(correctStart, correctEnd):
 def aggregateVisual(start, end, intervalLength):
     """Time aggregation of visual data in the given interval in subintervals
        of the given length."""  
-    conn = database.createDatabaseConnection()
     detReader = DetectorReader()
-    rows = database.execSQL(conn, """
+    # the rows are streamed from a server side cursor which would not survive
+    # the commits of the inserts, so these use a separate connection
+    outConn = database.createOutputConnection()
+    rows = database.execSQLIter(database.getConnection(), """
         SELECT edge_id, q_pkw, q_lkw, v_pkw, v_lkw, data_time, quality
-        FROM corrected_visual_data WHERE data_time >= '%s' AND data_time < '%s'
-        ORDER BY data_time""" % (start, end))
+        FROM corrected_visual_data WHERE data_time >= %s AND data_time < %s
+        ORDER BY data_time""", "visual_rows", params=(start, end))
     nextInterval = start + intervalLength
     for row in rows:
         cmpTime = database.as_time(row[5])
         if cmpTime >= nextInterval:
-            insertAggregated(conn, "visual", detReader,
+            insertAggregated(outConn, "visual", detReader,
                              nextInterval, intervalLength)
             while cmpTime >= nextInterval:
                 nextInterval += intervalLength
@@ -91,5 +93,5 @@ def aggregateVisual(start, end, intervalLength):
             detReader.addFlow(row[0], row[1], row[3], row[6])
         if row[2]:
             detReader.addFlow(row[0], row[2], row[4], row[6])
-    insertAggregated(conn, "visual", detReader, nextInterval,
+    insertAggregated(outConn, "visual", detReader, nextInterval,
                      intervalLength, doClose=True)
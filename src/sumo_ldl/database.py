@@ -12,11 +12,12 @@
 Database interface for the Delphi simulation setup.
 """
 
-import sys, traceback
+import sys, io, time, random, traceback
 from datetime import datetime, timedelta
+from functools import lru_cache
 
 import psycopg2
-from psycopg2.extras import execute_batch
+from psycopg2.extras import execute_batch, execute_values
 
 from sumo_ldl import setting
 
@@ -31,15 +32,78 @@ OperationalError = psycopg2.OperationalError
 
 VERBOSE = False
 
+# serialization failure, deadlock and lock timeout are retried with exponential backoff
+_RETRY_SQLSTATES = ("40001", "40P01", "55P03")
+_MAX_ATTEMPTS = 5
+
+# number of released PostgreSQL connections kept per database for reuse and their maximum idle time
+_MAX_IDLE = 4
+_MAX_IDLE_SECONDS = 300
+_IDLE = {} # (prefix, host, user, db) -> list of (release time, idle connection)
+
+class _PooledConnection(psycopg2.extensions.connection):
+    """A PostgreSQL connection which remembers the pool it can be released to
+    by closeDatabaseConnection."""
+    poolKey = None
+
+def _isAlive(conn):
+    """Whether the idle connection still works, the server may have dropped it meanwhile"""
+    if conn.closed:
+        return False
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1")
+        cursor.close()
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def _closeExpired(idle, now):
+    """Closes and removes the connections which were idle for too long"""
+    for released, conn in idle:
+        if now - released >= _MAX_IDLE_SECONDS:
+            conn.close()
+    idle[:] = [(released, conn) for released, conn in idle if not conn.closed]
+
+def closeDatabaseConnection(conn):
+    """Releases a connection returned by createDatabaseConnection.
+    PostgreSQL connections are rolled back and kept for reuse by createDatabaseConnection,
+    all others are closed. The connection must not be used afterwards."""
+    if not isinstance(conn, _PooledConnection) or conn is _CONNECTION:
+        conn.close()
+        return
+    now = time.monotonic()
+    idle = _IDLE.setdefault(conn.poolKey, [])
+    _closeExpired(idle, now)
+    if not conn.closed and len(idle) < _MAX_IDLE and all(c is not conn for released, c in idle):
+        try:
+            conn.rollback()
+            idle.append((now, conn))
+            return
+        except psycopg2.Error:
+            pass
+    conn.close()
+
 def createDatabaseConnection(prefix="", dbPrefix=""):
     if setting.hasOption("Database", "testinput"):
         return setting.getOption("Database", "testinput")
 
     if not haveOracle or (setting.hasOption("Database", "postgres") and setting.getOptionBool("Database", "postgres")):
-        conn = psycopg2.connect(host = setting.getOption("Database", prefix + "host"),
-                            user = setting.getOption("Database", prefix + "user"),
-                            password = setting.getOption("Database", prefix + "passwd"),
-                            database = setting.getOption("Database", dbPrefix + "db"))
+        host = setting.getOption("Database", prefix + "host")
+        user = setting.getOption("Database", prefix + "user")
+        db = setting.getOption("Database", dbPrefix + "db")
+        key = (prefix, host, user, db)
+        idle = _IDLE.get(key, [])
+        _closeExpired(idle, time.monotonic())
+        while idle:
+            released, conn = idle.pop()
+            if _isAlive(conn):
+                return conn
+            conn.close()
+        conn = psycopg2.connect(host=host, user=user, password=setting.getOption("Database", prefix + "passwd"),
+                                database=db, connection_factory=_PooledConnection)
+        conn.poolKey = key
     else:
         conn = cx_Oracle.connect("%s/%s@%s/%s" % (setting.getOption("Database", prefix + "user"),
                                                   setting.getOption("Database", prefix + "passwd"),
@@ -49,6 +113,22 @@ def createDatabaseConnection(prefix="", dbPrefix=""):
         print("connection: ", conn)
     return conn
 
+_CONNECTION = None
+
+def getConnection():
+    """Returns a connection which is kept open across steps and created on first use.
+    Callers must not close it. Any pending transaction is rolled back."""
+    global _CONNECTION
+    if _CONNECTION is None or getattr(_CONNECTION, "closed", False):
+        _CONNECTION = createDatabaseConnection()
+    elif hasattr(_CONNECTION, "rollback"):
+        _CONNECTION.rollback()
+    return _CONNECTION
+
+def isPostgres(conn):
+    """Whether conn is a PostgreSQL connection (as opposed to Oracle or test input)"""
+    return isinstance(conn, psycopg2.extensions.connection)
+
 def createOutputConnection():
     if setting.hasOption("Database", "separateOutput") and setting.getOptionBool("Database", "separateOutput"):
         return createDatabaseConnection("output", "output")
@@ -61,43 +141,75 @@ def debug_print(command):
         print("length: ", len(command))
         print(command[:printLength], (' ...' if len(command) > printLength else ''))
 
+def _executeMany(cursor, command, manySet, useValues):
+    if not isinstance(cursor, psycopg2.extensions.cursor):
+        cursor.executemany(command, manySet)
+        return
+    if useValues:
+        execute_values(cursor, command, manySet, page_size=1000)
+        return
+    execute_batch(cursor, command, manySet)
+
+def _canCombine(conn, commands, search_path, manySet, params):
+    """Whether the search path and the commands can be sent as one multi statement string.
+    This is only supported by PostgreSQL and parameters must belong to a single command."""
+    if manySet is not None or not isPostgres(conn):
+        return False
+    if params is not None:
+        return len(commands) == 1 and (not search_path or "%" not in search_path)
+    return len(commands) > 1 or bool(search_path)
+
+def _executeCommands(conn, cursor, commands, search_path, manySet, useValues, params):
+    if _canCombine(conn, commands, search_path, manySet, params):
+        # send the search path and all commands in a single round trip,
+        # the results are the ones of the last command as before
+        combined = ";\n".join(([search_path] if search_path else []) + commands)
+        debug_print(combined)
+        cursor.execute(combined, params)
+        return
+    if search_path:
+        debug_print(search_path)
+        cursor.execute(search_path)
+    for command in commands:
+        debug_print(command)
+        if manySet is not None:
+            debug_print(str(manySet[:10]))
+            _executeMany(cursor, command, manySet, useValues)
+        else:
+            cursor.execute(command, params)
+
 def execSQL(conn, commands, doCommit=False, manySet=None, fetchId=False,
-            returnDescription=False, search_path=None, returnRowcount=False):
+            returnDescription=False, search_path=None, returnRowcount=False, useValues=False,
+            params=None):
     """Executes the given SQL commands for the given database connection.
     Returns all resulting rows for reading statements, None for writing.
-    If doCommit is True a commit is issued."""
-    pre = datetime.now()
+    If doCommit is True a commit is issued.
+    If useValues is True the commands contain a single "VALUES %s" placeholder
+    which is expanded to multiple rows of manySet per statement.
+    If params are given they are passed to every command (without manySet)."""
+    pre = time.perf_counter()
     if not isinstance(commands, list):
         commands = [commands]
     try:
         cursor = conn.cursor()
-        try:
-            if search_path is None and setting.dbSchema is not None:
-                search_path = setting.dbSchema.SEARCH_PATH
-            if search_path:
-                debug_print(search_path)
-                cursor.execute(search_path)
-            for command in commands:
-                debug_print(command)
-                if manySet is not None:
-                    debug_print(str(manySet[:10]))
-                    execute_batch(cursor, command, manySet)
-                else:
-                    cursor.execute(command)
-        except OperationalError as message:
-            if message[0] in [1205, 1213]: # retry on lock wait timeout and deadlock
-                if message[0] == 1205:
-                    conn.rollback()
-                print("Warning! %s" % message[1], file=sys.stderr)
-                print(" Retrying once.", file=sys.stderr)
-                for command in commands:
-                    debug_print(command)
-                    if manySet != None:
-                        cursor.executemany(command, manySet)
-                    else:
-                        cursor.execute(command)
-            else:
-                raise
+        if search_path is None and setting.dbSchema is not None:
+            search_path = setting.dbSchema.SEARCH_PATH
+        # retrying needs a rollback which would also discard earlier uncommitted statements,
+        # so only retry if the commands are the whole transaction
+        canRetry = isPostgres(conn) and conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        for attempt in range(_MAX_ATTEMPTS):
+            try:
+                _executeCommands(conn, cursor, commands, search_path, manySet, useValues, params)
+                break
+            except OperationalError as error:
+                if (not canRetry or getattr(error, "pgcode", None) not in _RETRY_SQLSTATES
+                        or attempt == _MAX_ATTEMPTS - 1):
+                    raise
+                conn.rollback()
+                print("Warning! %s" % str(error).strip(), file=sys.stderr)
+                print(" Retrying (attempt %s of %s)." % (attempt + 2, _MAX_ATTEMPTS), file=sys.stderr)
+                time.sleep(0.05 * 2 ** attempt + random.random() * 0.05)
+        command = commands[-1]
         if manySet is not None or doCommit or command.upper().startswith("DELETE"):
             rows = None
         else:
@@ -119,7 +231,7 @@ def execSQL(conn, commands, doCommit=False, manySet=None, fetchId=False,
             print("Warning! %s" % message, file=sys.stderr)
         print("Error on query '%s'" % commands, file=sys.stderr)
         raise
-    setting.databaseTime += datetime.now() - pre
+    setting.databaseTime += time.perf_counter() - pre
     if returnDescription:
         return rows, description
     elif returnRowcount:
@@ -127,26 +239,108 @@ def execSQL(conn, commands, doCommit=False, manySet=None, fetchId=False,
     else:
         return rows
 
+def execSQLIter(conn, command, name="ldl_iter", itersize=10000, search_path=None, params=None):
+    """Executes the given reading SQL command (with optional query parameters)
+    and yields the resulting rows.
+    For PostgreSQL a server side cursor is used, so only itersize rows
+    are held in memory at once."""
+    pre = time.perf_counter()
+    if search_path is None and setting.dbSchema is not None:
+        search_path = setting.dbSchema.SEARCH_PATH
+    if search_path:
+        debug_print(search_path)
+        cursor = conn.cursor()
+        cursor.execute(search_path)
+        cursor.close()
+    if isPostgres(conn):
+        cursor = conn.cursor(name=name)
+        cursor.itersize = itersize
+    else:
+        cursor = conn.cursor()
+        cursor.arraysize = itersize
+    try:
+        debug_print(command)
+        cursor.execute(command, params)
+        rows = cursor.fetchmany(itersize)
+        setting.databaseTime += time.perf_counter() - pre
+        while rows:
+            for row in rows:
+                yield row
+            pre = time.perf_counter()
+            rows = cursor.fetchmany(itersize)
+            setting.databaseTime += time.perf_counter() - pre
+    except OperationalError:
+        print("Error on query '%s'" % command, file=sys.stderr)
+        raise
+    finally:
+        cursor.close()
+
+def _copyValue(value):
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+def _copyBuffer(rows):
+    """Returns a file like object with the rows in COPY text format."""
+    buf = io.StringIO()
+    for row in rows:
+        buf.write("\t".join([_copyValue(value) for value in row]))
+        buf.write("\n")
+    buf.seek(0)
+    return buf
+
+def copyRows(conn, table, columns, rows, search_path=None):
+    """Bulk loads the rows into the given columns of the table using
+    COPY FROM STDIN (PostgreSQL only). None values are written as NULL.
+    A commit is issued."""
+    pre = time.perf_counter()
+    buf = _copyBuffer(rows)
+    command = "COPY %s (%s) FROM STDIN" % (table, ", ".join(columns))
+    cursor = conn.cursor()
+    try:
+        if search_path is None and setting.dbSchema is not None:
+            search_path = setting.dbSchema.SEARCH_PATH
+        if search_path:
+            debug_print(search_path)
+            cursor.execute(search_path)
+        debug_print(command)
+        cursor.copy_expert(command, buf)
+        conn.commit()
+    except:
+        print("Error on query '%s'" % command, file=sys.stderr)
+        raise
+    finally:
+        cursor.close()
+    setting.databaseTime += time.perf_counter() - pre
+
 def as_time(db_val):
     """return db_val as datetime"""
     if isinstance(db_val, str): # old pg driver
-        return datetime.strptime(db_val,'%Y-%m-%d %H:%M:%S')
+        return _parseTime(db_val)
     else:
         return db_val
 
+@lru_cache(maxsize=65536)
+def _parseTime(db_val):
+    return datetime.strptime(db_val,'%Y-%m-%d %H:%M:%S')
+
 def as_interval(db_val):
     """return db_val as timedelta"""
     if isinstance(db_val, str): # old pg driver
-        fields = db_val.split()
-        if len(fields) > 1: # days >= 1
-            days, dummy, hms = fields
-        else: # days < 1
-            days, hms = 0, fields[0]
-        hours, minutes, seconds = hms.split(':')
-        return timedelta(days=int(days), hours=int(hours), 
-                minutes=int(minutes), seconds=float(seconds))
+        return _parseInterval(db_val)
     else:
         return db_val
 
+@lru_cache(maxsize=65536)
+def _parseInterval(db_val):
+    fields = db_val.split()
+    if len(fields) > 1: # days >= 1
+        days, dummy, hms = fields
+    else: # days < 1
+        days, hms = 0, fields[0]
+    hours, minutes, seconds = hms.split(':')
+    return timedelta(days=int(days), hours=int(hours), 
+            minutes=int(minutes), seconds=float(seconds))
+
 def as_lon_lat(db_val):
     return db_val[6:-1].split()
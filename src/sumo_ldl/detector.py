@@ -17,10 +17,18 @@ detectors.
 """
 
 import os
-import sys, optparse, datetime
+import sys, io, optparse, datetime
+import bisect
 from itertools import groupby
-import codecs
-from xml.sax import parse, handler, saxutils
+from operator import attrgetter
+import re
+from xml.sax import handler, saxutils
+from xml.parsers import expat
+try:
+    from lxml import etree
+    haveLxml = True
+except ImportError:
+    haveLxml = False
 
 from sumo_ldl.tools import reversedMap
 from sumo_ldl import setting
@@ -30,6 +38,10 @@ MAX_POS_DEVIATION = 10
 AVERAGE = 1
 MAX = 2
 
+_DETECTOR_TEMPLATE = '        <detector_definition id="%s" %spos="%s" interval="%s"%s/>\n'
+_WRITE_BATCH = 8192 # number of output fragments collected before writing
+_WRITE_BUFFER_SIZE = 1 << 20
+
 def import_database_modules(schema):
     global pgdb
     global cx_Oracle
@@ -54,11 +66,38 @@ def import_database_modules(schema):
     import database
 
 
+def _parse(xmlFile, contentHandler):
+    """
+    Parse xmlFile calling startElement and endElement of the given handler.
+    Uses lxml's iterparse if available (discarding processed elements)
+    and falls back to expat otherwise, passing the attributes as a dict.
+    """
+    if not haveLxml:
+        parser = expat.ParserCreate()
+        parser.StartElementHandler = contentHandler.startElement
+        parser.EndElementHandler = contentHandler.endElement
+        if hasattr(xmlFile, "read"):
+            parser.ParseFile(xmlFile)
+        else:
+            with open(xmlFile, "rb") as f:
+                parser.ParseFile(f)
+        return
+    for event, elem in etree.iterparse(xmlFile, events=('start', 'end'), huge_tree=True):
+        if event == 'start':
+            contentHandler.startElement(elem.tag, elem.attrib)
+        else:
+            contentHandler.endElement(elem.tag)
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+
 class Detector:
     OPTIONAL_FIELDS = [
             'description',
             'vendor',
             'direction_of_traffic']
+    __slots__ = ['id', 'lane', 'interval'] + OPTIONAL_FIELDS
 
     def __init__(self, id, lane, interval, **attrs):
         self.id = id
@@ -66,7 +105,7 @@ class Detector:
         self.interval = interval
         for a in Detector.OPTIONAL_FIELDS:
             setattr(self, a, None)
-        for a, value in list(attrs.items()):
+        for a, value in attrs.items():
             if a in Detector.OPTIONAL_FIELDS:
                 setattr(self, a, value)
             else:
@@ -87,6 +126,9 @@ class DetectorGroupData:
     """
     Storage for data in a detector group
     """
+    __slots__ = ['detectors', 'groupID', 'pos', 'latitude', 'longitude', 'streetType',
+                 'qualityMeasure', 'totalFlow', 'avgSpeed', 'quality', 'coverage',
+                 'entryCount'] + OPTIONAL_FIELDS
     def __init__(self, pos, qualityMeasure=AVERAGE):
         self.detectors = []
         self.groupID = None
@@ -116,39 +158,41 @@ class DetectorGroupData:
         """
         self.detectors.append(Detector(detID, lane, interval, **attrs))
 
-    def _updateSpeed(self, speed, oldWeight, newWeight):
-        """updated avgSpeed with weighted average of old and new speed value"""
-        if speed is not None:
-            if self.avgSpeed is None:
-                self.avgSpeed = 0 # init speed on first usable data point
-            self.avgSpeed = (self.avgSpeed * oldWeight + speed * newWeight) / (oldWeight + newWeight)
-
     def addDetFlow(self, flow, speed=None, quality=0, coverage=None):
         """
         Add a flow value and optionally speed and quality values to this group.
         Flow is simply summed, speed is averaged and quality is either
         average or maximum depending on the measure given at creation.
         """
-        # update flow and speed
-        if flow is not None and self.totalFlow is None:
-            self.totalFlow = 0 # init totalFlow on first usable data point
+        entryCount = self.entryCount
+        # update flow and speed, the speed average is initialized on the first usable data point
+        # averages use the running mean update avg += (new - avg) * weight / totalWeight
         if flow: # do not add zero flow
-            self._updateSpeed(speed, self.totalFlow, flow)
-            self.totalFlow += flow
-        elif flow is None and speed is not None:
-            # FCD data
-            self._updateSpeed(speed, self.entryCount, 1)
+            totalFlow = (self.totalFlow or 0) + flow
+            if speed is not None:
+                avgSpeed = self.avgSpeed or 0
+                self.avgSpeed = avgSpeed + (speed - avgSpeed) * flow / totalFlow
+            self.totalFlow = totalFlow
+        elif flow is None:
+            if speed is not None:
+                # FCD data
+                avgSpeed = self.avgSpeed or 0
+                self.avgSpeed = avgSpeed + (speed - avgSpeed) / (entryCount + 1)
+        elif self.totalFlow is None:
+            self.totalFlow = 0 # init totalFlow on first usable data point
         # update quality
-        if self.quality is None and quality is not None:
-            self.quality = 0 # init quality on first usable data point
-        elif self.quality is not None and quality is None:
-            quality = 0 # patch for averaging
-        if self.quality is not None and quality is not None:
-            if (self.qualityMeasure == AVERAGE):
-                self.quality = (self.quality * self.entryCount + quality) / (self.entryCount + 1)
-            elif (self.qualityMeasure == MAX):
+        if self.quality is None:
+            if quality is not None:
+                # init quality on first usable data point
+                self.quality = quality / (entryCount + 1) if self.qualityMeasure == AVERAGE else max(0, quality)
+        else:
+            if quality is None:
+                quality = 0 # patch for averaging
+            if self.qualityMeasure == AVERAGE:
+                self.quality += (quality - self.quality) / (entryCount + 1)
+            elif self.qualityMeasure == MAX:
                 self.quality = max(self.quality, quality)
-        self.entryCount += 1
+        self.entryCount = entryCount + 1
         # udpate coverage
         if self.coverage is None and coverage is not None:
             self.coverage = 0 # init coverage on first usable data point
@@ -159,6 +203,11 @@ class DetectorGroupData:
         return str(self.ids)
 
 
+_DETECTOR_OPTIONAL = frozenset(Detector.OPTIONAL_FIELDS)
+_GROUP_OPTIONAL = frozenset(DetectorGroupData.OPTIONAL_FIELDS)
+_NULL_VALUES = frozenset(('None', 'Null', 'NONE', 'NULL'))
+
+
 class DetectorReader(handler.ContentHandler):
     """
     Collection of detector groups together with methods for adding groups,
@@ -167,14 +216,15 @@ class DetectorReader(handler.ContentHandler):
 
     def __init__(self, detFile=None, dbSchemaFile=None):
         handler.ContentHandler.__init__(self)
-        self.hasIDs = 0
+        self._hasIDs = 0
         self._edge2DetData = {}
+        self._edge2PosIndex = {} # edge -> (sorted group positions, groups in the same order)
         self._det2edge = {}
         self._det2group = {}
         self._currentGroup = None
         self._currentEdge = None
         if detFile:
-            parse(detFile, self)
+            _parse(detFile, self)
         if dbSchemaFile is not None:
             import_database_modules(dbSchemaFile)
 
@@ -184,44 +234,59 @@ class DetectorReader(handler.ContentHandler):
         Write XML-description of the detectors stored in a format readable by
         SUMO's dfrouter.
         """
-        print("""<?xml version="1.0" encoding="ISO-8859-1"?>
+        parts = ["""<?xml version="1.0" encoding="ISO-8859-1"?>
 <!-- generated on %s by $Id: detector.py 9186 2021-03-16 15:11:10Z wang_yu $ -->
-<a>""" % datetime.datetime.now(), file=file)
-        for edge in sorted(list(self._edge2DetData.keys()), key=str):
+<a>
+""" % datetime.datetime.now()]
+        out = file
+        if hasattr(file, "buffer"):
+            # write through a large buffer in the encoding declared in the header
+            file.flush()
+            out = io.TextIOWrapper(io.BufferedWriter(file.buffer, _WRITE_BUFFER_SIZE),
+                                   encoding="iso-8859-1", errors="xmlcharrefreplace")
+        append = parts.append
+        escape = saxutils.escape
+        groupFields = DetectorGroupData.OPTIONAL_FIELDS
+        detectorFields = Detector.OPTIONAL_FIELDS
+        detectorValues = attrgetter(*detectorFields)
+        for edge in sorted(self._edge2DetData, key=str):
             for group in self._edge2DetData[edge]:
-                file.write('    <group pos="%s"' % group.pos)
+                append('    <group pos="%s"' % group.pos)
                 if group.latitude:
-                    file.write(' lat="%s" lon="%s"' % (group.latitude, group.longitude))
-                for attr in DetectorGroupData.OPTIONAL_FIELDS:
-                    if getattr(group, attr): 
-                        file.write(' %s="%s"' % (attr, saxutils.escape(getattr(group, attr))))
+                    append(' lat="%s" lon="%s"' % (group.latitude, group.longitude))
+                for attr in groupFields:
+                    value = getattr(group, attr)
+                    if value:
+                        append(' %s="%s"' % (attr, escape(value)))
                 if hasattr(group, "loop_type"):
-                    file.write(' loop_type="%s"' % (group.loop_type))
-                file.write(' street_type="%s" orig_edge="%s">\n' % (group.streetType, edge))
-                if guessLanes:
-                    minLane = 9
-                    for d in group.detectors:
-                        try:
-                            minLane = min(minLane, int(d.id[-1]))
-                        except:
-                            minLane = None
-                            break
-                    if minLane is not None:
-                        for d in group.detectors:
-                            d.lane = int(d.id[-1]) - minLane + 1
+                    append(' loop_type="%s"' % (group.loop_type))
+                append(' street_type="%s" orig_edge="%s">\n' % (group.streetType, edge))
+                if guessLanes and group.detectors:
+                    lastChars = [d.id[-1:] for d in group.detectors]
+                    if all(c.isdecimal() for c in lastChars):
+                        lanes = [int(c) for c in lastChars]
+                        offset = min(lanes) - 1
+                        for d, lane in zip(group.detectors, lanes):
+                            d.lane = lane - offset
 
                 for detector in group.detectors:
                     laneString = ""
                     if detector.lane != None: 
                         laneString = 'lane="%s_%s" ' % (edge, detector.lane-1)
-                    optional = ""
-                    for attr in Detector.OPTIONAL_FIELDS:
-                        if getattr(detector, attr) is not None:
-                            optional += ' %s="%s"' % (attr, getattr(detector, attr))
-                    file.write('        <detector_definition id="%s"' % saxutils.escape(detector.id))
-                    file.write(' %spos="%s" interval="%s"%s/>\n' % (laneString, group.pos, detector.interval, optional))
-                file.write("    </group>\n")
-        file.write("</a>\n")
+                    optional = "".join([' %s="%s"' % (attr, value) for attr, value in
+                                        zip(detectorFields, detectorValues(detector))
+                                        if value is not None])
+                    append(_DETECTOR_TEMPLATE % (escape(detector.id),
+                           laneString, group.pos, detector.interval, optional))
+                append("    </group>\n")
+                if len(parts) > _WRITE_BATCH:
+                    out.write("".join(parts))
+                    del parts[:]
+        parts.append("</a>\n")
+        out.write("".join(parts))
+        if out is not file:
+            # flush both wrappers without closing the underlying stream
+            out.detach().detach()
 
     def writeDetectorDB(self, conn, clean=True):
         """
@@ -236,7 +301,9 @@ class DetectorReader(handler.ContentHandler):
                 database.execSQL(conn, "SELECT setval('%s_induction_loop_id_seq', 1, false)" % dbSchema.Tables.induction_loop, True)
                 database.execSQL(conn, "SELECT setval('%s_induction_loop_group_id_seq', 1, false)" % dbSchema.Tables.induction_loop_group, True)
         edgeMap = dbSchema.AggregateData.getSimulationEdgeMap(conn)
-        for edge, groups in list(self._edge2DetData.items()):
+        # group ids are needed for the detectors, so only detector inserts are batched
+        detectorCommands = []
+        for edge, groups in self._edge2DetData.items():
             if not edge in edgeMap:
                 print("Skipping detector for unknown edge %s" % edge, file=sys.stderr)
                 continue
@@ -256,10 +323,11 @@ class DetectorReader(handler.ContentHandler):
                     for detector in group.detectors:
                         if detector.lane is None:
                             detector.lane = 1
-                        database.execSQL(conn,
-                                dbSchema.Detector.insert_induction_loop_query(groupID, detector), True)
+                        detectorCommands.append(dbSchema.Detector.insert_induction_loop_query(groupID, detector))
                 else:
                     print("Warning! Detector group %s (section %s) could not be inserted." % (group.description, edge), file=sys.stderr)
+        if detectorCommands:
+            database.execSQL(conn, detectorCommands, True)
 
     def addDetector(self, detID, pos, edge, lane=None, interval=None, lon=None, lat=None, type=None, **attrs):
         """
@@ -274,12 +342,8 @@ class DetectorReader(handler.ContentHandler):
             return
         group = self._currentGroup
         if group == None:
-            if not edge in self._edge2DetData:
-                self._edge2DetData[edge] = []
-            for data in self._edge2DetData[edge]:
-                if abs(data.pos - pos) <= MAX_POS_DEVIATION:
-                    group = data
-                    break
+            groups = self._edge2DetData.setdefault(edge, [])
+            group = self._findNearbyGroup(edge, pos)
         if group == None:
             group = DetectorGroupData(pos)
             if lon:
@@ -288,22 +352,46 @@ class DetectorReader(handler.ContentHandler):
                 group.latitude = lat
             if type:
                 group.streetType = type
-            self._edge2DetData[edge].append(group)
+            groups.append(group)
+            self._indexGroup(edge, group)
         if not interval:
             interval = "60"
         group.addDetector(detID, lane, interval, **attrs)
         self._det2edge[detID] = edge
         self._det2group[detID] = group
 
+    def _indexGroup(self, edge, group):
+        """
+        Insert the group into the position index of the edge.
+        """
+        if group.pos is None:
+            return
+        positions, groups = self._edge2PosIndex.setdefault(edge, ([], []))
+        idx = bisect.bisect_right(positions, group.pos)
+        positions.insert(idx, group.pos)
+        groups.insert(idx, group)
+
+    def _findNearbyGroup(self, edge, pos):
+        """
+        Return the group with the smallest position on the edge which is
+        at most MAX_POS_DEVIATION away from pos or None if there is none.
+        """
+        if edge not in self._edge2PosIndex:
+            return None
+        positions, groups = self._edge2PosIndex[edge]
+        idx = bisect.bisect_left(positions, pos - MAX_POS_DEVIATION)
+        if idx < len(positions) and positions[idx] <= pos + MAX_POS_DEVIATION:
+            return groups[idx]
+        return None
+
     def addGroup(self, pos, edge, qualityMeasure=AVERAGE):
         """
         A new group is created, which is the current group hereafter.
         """
         self._currentGroup = DetectorGroupData(pos, qualityMeasure)
         self._currentEdge = edge
-        if not edge in self._edge2DetData:
-            self._edge2DetData[edge] = []
-        self._edge2DetData[edge].append(self._currentGroup)
+        self._edge2DetData.setdefault(edge, []).append(self._currentGroup)
+        self._indexGroup(edge, self._currentGroup)
         return self._currentGroup
         
     def startElement(self, name, attrs):
@@ -311,41 +399,37 @@ class DetectorReader(handler.ContentHandler):
         XML-Handler function for parsing XML-descriptions.
         """
         if name == 'detector_definition':
+            laneID = attrs.get('lane')
             if self._currentEdge:
                 edge = self._currentEdge
             else:
-                edge = attrs['lane'][:-2]
+                edge = laneID[:-2]
             lane = None
-            if 'lane' in attrs:
-                lane = int(attrs['lane'][-1]) + 1
-            interval = None
-            if 'interval' in attrs:
-                interval = attrs['interval']
+            if laneID is not None:
+                lane = int(laneID[-1]) + 1
             # optional attributes
-            optional = {}
-            for attr in Detector.OPTIONAL_FIELDS:
-                if attr in attrs:
-                    optional[attr] = attrs[attr]
-            pos = None if attrs['pos'] in ('None', 'Null', 'NONE', 'NULL') else float(attrs['pos'])
-            self.addDetector(attrs['id'], pos, edge, lane, interval, **optional)
+            optional = {attr: attrs[attr] for attr in _DETECTOR_OPTIONAL.intersection(attrs.keys())}
+            pos = attrs['pos']
+            pos = None if pos in _NULL_VALUES else float(pos)
+            self.addDetector(attrs['id'], pos, edge, lane, attrs.get('interval'), **optional)
         elif name == 'group':
             group = self.addGroup(float(attrs['pos']), attrs['orig_edge'])            
-            if 'group_id' in attrs:
-                group.groupID = int(attrs['group_id'])
-            if 'lat' in attrs:
-                group.latitude = float(attrs['lat']) 
+            groupID = attrs.get('group_id')
+            if groupID is not None:
+                group.groupID = int(groupID)
+            lat = attrs.get('lat')
+            if lat is not None:
+                group.latitude = float(lat) 
                 group.longitude = float(attrs['lon']) 
-            if 'street_type' in attrs:
-                group.streetType = attrs['street_type']
-            for attr in DetectorGroupData.OPTIONAL_FIELDS:
-                if attr in attrs:
-                    setattr(group, attr, attrs[attr])
+            group.streetType = attrs.get('street_type', group.streetType)
+            for attr in _GROUP_OPTIONAL.intersection(attrs.keys()):
+                setattr(group, attr, attrs[attr])
         elif name == 'a':
             if 'with_id' in attrs:
                 if attrs['with_id'] == 'true':
-                    self.hasIDs = 1
+                    self._hasIDs = 1
                 else:
-                    self.hasIDs = 0
+                    self._hasIDs = 0
 
     def endElement(self, name):
         """
@@ -382,7 +466,7 @@ class DetectorReader(handler.ContentHandler):
         """
         Return whether the input file has id or not
         """
-        return self.hasIDs()
+        return bool(self._hasIDs)
     
     def hasEdge(self, edge):
         """
@@ -403,6 +487,9 @@ class DetectorReader(handler.ContentHandler):
     def getDetector(self, id):
         return self._det2group[id]
 
+_ELMAR_DETECTOR_TYPES = frozenset((b"5", b"6"))
+_DISTANCE_PATTERN = re.compile(r';DISTANCE([^;]*)')
+
 def readDetectors(detectorFilename, edges=None):
     """
     Parse detectors from Elmar's point collection.
@@ -414,38 +501,39 @@ def readDetectors(detectorFilename, edges=None):
     at the last but one position (starting with "DISTANCE").
     """
     detReader = DetectorReader()
-    detectorFile = codecs.open(detectorFilename, "r", "latin1")
-    for l in detectorFile:
-        if l[0] != '#':
-            detDef = l.strip().split("\t")
-            if len(detDef) < 6 or detDef[1] not in ["5", "6"]:
-                continue
-            edge = detDef[5]
-            lon = float(detDef[3])/100000.
-            lat = float(detDef[4])/100000.
-            type = None
-            if detDef[1] == "6":
-                type = "urban"
-            detName = detDef[2].split(';')
-            pos = 0.0
-            for entry in detName[1:]:
-                if entry.startswith('DISTANCE'):
-                    pos = float(entry[8:])
-            if edges:
-                if edge not in edges:
-                    print("Warning! Unknown edge %s." % edge, sys.stderr)
-                else:
-                    for splitEdge in edges[edge]:
-                        if pos < splitEdge._start + splitEdge._length:
+    # the file is split as bytes, only the name and the edge need to be decoded
+    with open(detectorFilename, "rb") as detectorFile:
+        for l in detectorFile:
+            if l[:1] != b'#':
+                detDef = l.strip().split(b"\t")
+                if len(detDef) < 6 or detDef[1] not in _ELMAR_DETECTOR_TYPES:
+                    continue
+                edge = detDef[5].decode("latin1")
+                lon = float(detDef[3])/100000.
+                lat = float(detDef[4])/100000.
+                type = None
+                if detDef[1] == b"6":
+                    type = "urban"
+                detName = detDef[2].decode("latin1")
+                pos = 0.0
+                distances = _DISTANCE_PATTERN.findall(detName)
+                if distances:
+                    pos = float(distances[-1])
+                detName = detName.split(';', 1)[0]
+                if edges:
+                    if edge not in edges:
+                        print("Warning! Unknown edge %s." % edge, sys.stderr)
+                    else:
+                        for splitEdge in edges[edge]:
+                            if pos < splitEdge._start + splitEdge._length:
+                                edge = splitEdge._id
+                                pos -= splitEdge._start
+                                break                    
+                        if pos > splitEdge._start + splitEdge._length:
+                            print("Warning! Invalid detector pos on %s." % edge, sys.stderr)
                             edge = splitEdge._id
-                            pos -= splitEdge._start
-                            break                    
-                    if pos > splitEdge._start + splitEdge._length:
-                        print("Warning! Invalid detector pos on %s." % edge, sys.stderr)
-                        edge = splitEdge._id
-                        pos = splitEdge._start + splitEdge._length
-            detReader.addDetector(detName[0], pos, edge, lon=lon, lat=lat, type=type)
-    detectorFile.close()
+                            pos = splitEdge._start + splitEdge._length
+                detReader.addDetector(detName, pos, edge, lon=lon, lat=lat, type=type)
     return detReader
 
 def readDetectorDB(conn, dismissWhenNoLane=False):
@@ -465,8 +553,8 @@ def readDetectorDB(conn, dismissWhenNoLane=False):
                dbSchema.Tables.induction_loop,
                dbSchema.Tables.induction_loop_group,
                dbSchema.Tables.induction_loop_group_edge)
-    rows = database.execSQL(conn, command)
     reverseEdgeMap = reversedMap(dbSchema.AggregateData.getSimulationEdgeMap(conn))
+    rows = database.execSQLIter(conn, command, "detector_rows")
     for group_id, subrows in groupby(rows, lambda x:x[0]):
         subrows = list(subrows)
         group_id, det_id, lane_no, description, loop_interval, navteq_id, position, loop_type, street_type, point = subrows[0]
@@ -489,8 +577,9 @@ class Edge:
         self._length = -1
         self._numLanes = 0
         self._start = 0.0
-        if "." in edgeID:
-            self._start = float(edgeID[edgeID.index(".")+1:])
+        self._baseID, sep, start = edgeID.partition(".")
+        if sep:
+            self._start = float(start)
 
     def __repr__(self):
         return self._id
@@ -501,7 +590,9 @@ class EdgeReader(handler.ContentHandler):
         handler.ContentHandler.__init__(self)
         self._currentEdge = None
         self._edges = {}
-        parse(netFile, self)
+        _parse(netFile, self)
+        for edges in self._edges.values():
+            edges.sort(key=attrgetter("_start"))
 
     def getEdges(self):
         return self._edges
@@ -521,17 +612,9 @@ class EdgeReader(handler.ContentHandler):
         XML-Handler function for parsing XML-descriptions.
         """
         if name == 'edge':
-            id = self._currentEdge._id
-            if "." in id:
-                id = id[:id.index(".")]
-            if id not in self._edges:
-                self._edges[id] = [self._currentEdge]
-            else:
-                edges = self._edges[id]
-                idx = 0
-                while idx < len(edges) and edges[idx]._start < self._currentEdge._start:
-                    idx += 1
-                edges.insert(idx, self._currentEdge)
+            id = self._currentEdge._baseID
+            # sorted by start position once the whole file has been parsed
+            self._edges.setdefault(id, []).append(self._currentEdge)
             self._currentEdge = None
 
 
@@ -20,40 +20,72 @@ from . import database
 from .setting import dbSchema
 
 MAX_FLOW = 2500
-MAX_SPEED = {
-        'PKW': 250 * (1.0 / dbSchema.EvalDetector.kmhMultiplier),
-        'LKW': 120 * (1.0 / dbSchema.EvalDetector.kmhMultiplier)
-        }
+MAX_SPEED_PKW = 250 * (1.0 / dbSchema.EvalDetector.kmhMultiplier)
+MAX_SPEED_LKW = 120 * (1.0 / dbSchema.EvalDetector.kmhMultiplier)
+MAX_SPEED = {'PKW': MAX_SPEED_PKW, 'LKW': MAX_SPEED_LKW}
 
-LENGTH = {'PKW' : 5, 'LKW': 10} # meter
+LENGTH_PKW = 5 # meter
+LENGTH_LKW = 10 # meter
+LENGTH = {'PKW' : LENGTH_PKW, 'LKW': LENGTH_LKW}
+# converts speed to the empirical safety distance used by maxFlowPerHour
+_SAFETY_DISTANCE_FACTOR = dbSchema.EvalDetector.kmhMultiplier * 0.4
+
+# the schema of these regions uses dates as ids of the original data
+_DATE_ORIG_IDS = dbSchema.Loop.region_choices[0] in ("huainan", "leipzig")
 
 _DELTA = 0.001
 _ATTRIBUTE_QUALITY = {"qPKW" : 70, "qLKW" : 10, "vPKW" : 10, "vLKW" : 8, "Date" : 2}
 _ATTRIBUTE_QUALITY_NO_LKW = {"qPKW" : 80, "qLKW" : 0, "vPKW" : 18, "vLKW" : 0, "Date" : 2}
-
-
-def _getDataError(q, v, vMax, l, updateInterval):
-    """Returns the error code if the detector data has errors affecting flow and speed."""
-    if q == None:
-        return 1
+# bits of Data.fixed
+_FIXED_QPKW = 1
+_FIXED_QLKW = 2
+_FIXED_VPKW = 4
+_FIXED_VLKW = 8
+_FIXED_MASK = {"qPKW" : _FIXED_QPKW, "qLKW" : _FIXED_QLKW, "vPKW" : _FIXED_VPKW, "vLKW" : _FIXED_VLKW}
+# (quality, quality if fixed) for each attribute followed by the quality of the date
+_QUALITY_WEIGHTS, _QUALITY_WEIGHTS_NO_LKW = [
+        tuple((weights[attr], weights[attr] / 2) for attr in ("qPKW", "qLKW", "vPKW", "vLKW")) + (weights["Date"],)
+        for weights in (_ATTRIBUTE_QUALITY, _ATTRIBUTE_QUALITY_NO_LKW)]
+
+
+def _hourlyFactor(updateInterval):
+    """Returns the factor converting counts per update interval into flows per hour."""
+    return 3600. / updateInterval.seconds
+
+
+def _getError(q, v, vMax, l, hourlyFactor):
+    """Returns the error code of the detector data together with flags telling
+    whether flow and speed have to be discarded. Errors affecting flow and speed
+    take precedence over errors affecting speed only (see _getSpeedError).
+    Speed is also discarded if the flow is zero."""
+    if q is None:
+        return 1, True, True
     if q < 0.0:
-        return 2
-    if v != None:
-        flowPerHour = q * 3600 / updateInterval.seconds
-        if v < 0.0:
-            return 2
-        if v > 0 and q == 0.0:
-            return 5
-        if flowPerHour > MAX_FLOW or v > vMax:
-            return 7
-        if v > 0.0 and flowPerHour > maxFlowPerHour(v, l):
-            return 8
-    return 0
+        return 2, True, True
+    if v is None:
+        if q > 0.0:
+            return 1, False, True
+        return 0, False, True
+    if v < 0.0:
+        return 2, True, True
+    if v > 0 and q == 0.0:
+        return 5, True, True
+    flowPerHour = q * hourlyFactor
+    if flowPerHour > MAX_FLOW or v > vMax:
+        return 7, True, True
+    if v > 0.0 and flowPerHour > v * 3600 / (v * _SAFETY_DISTANCE_FACTOR + l):
+        return 8, True, True
+    # errors affecting speed only
+    if q > 0.0 and v == 0.0:
+        return 6, False, True
+    if v / vMax > 1.25:
+        return 9, False, True
+    return 0, False, q == 0
 
 
 def maxFlowPerHour(v, l):
     """0.4 * speed in km/h is an empirical safety distance value"""
-    return v * 3600 / (v * dbSchema.EvalDetector.kmhMultiplier * 0.4 + l)
+    return v * 3600 / (v * _SAFETY_DISTANCE_FACTOR + l)
 
 
 def isDataError(errorCode):
@@ -62,9 +94,9 @@ def isDataError(errorCode):
 
 def _getSpeedError(q, v, maxLaneSpeed):
     """Returns the error code if the detector data has errors affecting speed only."""
-    if q == None or (q > 0.0 and v == None):
+    if q is None or (q > 0.0 and v is None):
         return 1
-    if v != None:
+    if v is not None:
         if q > 0.0 and v == 0.0:
             return 6
         if v / maxLaneSpeed > 1.25:
@@ -74,15 +106,13 @@ def _getSpeedError(q, v, maxLaneSpeed):
 def _nullFloatString(arg):
     """Returns the string "NULL" for a None argument, and the argument
     converted to a string representing a float with two decimals otherwise."""
-    if arg == None:
-        return "NULL"
-    return "%.2f" % arg
+    return "NULL" if arg is None else format(arg, ".2f")
 
 def _isEqual(value, other):
     """Compares two floats for equality respecting a DELTA."""
-    if value == None:
-        return other == None
-    if other == None:
+    if value is None:
+        return other is None
+    if other is None:
         return False
     return abs(value - other) < _DELTA
 
@@ -95,28 +125,27 @@ def is_speed_attr(attr):
     return attr[0] == 'v'
 
 
-def to_type_or_null(value, type):
-    """Convert for DB write"""
-    if value is None:
-        return 'Null'
-    else:
-        return type(value)
+def _roundOrNull(value):
+    """Convert a flow for DB write (rounded to an integer)"""
+    return 'Null' if value is None else int(round(value))
 
-def round_int(x):
-    """Round to integer"""
-    return int(round(x))
+def _floatOrNull(value):
+    """Convert a speed for DB write"""
+    return 'Null' if value is None else float(value)
 
 
 class Data:
     """Represents a data item consisting mainly of speeds and flows."""
 
     attrs = ('qPKW', 'qLKW', 'vPKW', 'vLKW')
+    __slots__ = ('origID', 'detID', 'origDate', 'qPKW', 'qLKW', 'vPKW', 'vLKW',
+                 'errorPKW', 'errorLKW', 'fixed', 'toBeWritten')
     NO_ORIG_DATA = -1
     FORECAST_DATA = -2
 
     @classmethod
     def isOrigID(cls, id):
-        if dbSchema.Loop.region_choices[0] in ["huainan", "leipzig"]:
+        if _DATE_ORIG_IDS:
             return id is not None and int(id.weekday()) >= 0
         else:
             return id >= 0
@@ -125,7 +154,7 @@ class Data:
         self.origID = origID
         self.detID = detectorID
         self.origDate = origDate
-        if qKFZ != None and qLKW != None:
+        if qKFZ is not None and qLKW is not None:
             self.qPKW = qKFZ - qLKW
         else:
             self.qPKW = qKFZ                
@@ -134,24 +163,27 @@ class Data:
         self.vLKW = vLKW
         self.errorPKW = 0
         self.errorLKW = 0
-        self.fixed = set()
+        self.fixed = 0 # bit mask of the fixed attributes
         self.toBeWritten = True
 
     def hasOrigID(self):
-        if dbSchema.Loop.region_choices[0] in ["huainan", "leipzig"]:
-            if type(self.origID) == int:
-                return self.origID is not None and self.origID >= 0
-            else:
-                return self.origID is not None and self.origID.weekday() >= 0
-        else:
-            return self.origID is not None and self.origID >= 0
+        origID = self.origID
+        if origID is None:
+            return False
+        if _DATE_ORIG_IDS and type(origID) != int:
+            return origID.weekday() >= 0
+        return origID >= 0
 
     def getIfNotFixed(self, attr):
         """Returns the value of the attr if it was not fixed, None otherwise."""
-        if not self.hasOrigID() or attr in self.fixed:
+        if not self.hasOrigID() or self.fixed & _FIXED_MASK[attr]:
             return None
         return getattr(self, attr)
 
+    def markFixed(self, attr):
+        """Marks the value of attr as fixed without changing it."""
+        self.fixed |= _FIXED_MASK[attr]
+
     def fix(self, attr, value, updateInterval):
         """Gives the new value to attr, adds it to the "fixed" set
         and performs consistency checks. The checks are very similar to those
@@ -163,7 +195,7 @@ class Data:
         if is_flow_attr(attr):
             if value < 0:
                 return False # error 2
-            flowPerHour = value * 3600 / updateInterval.seconds
+            flowPerHour = value * _hourlyFactor(updateInterval)
             if flowPerHour > MAX_FLOW:
                 return False # error 7
         else: # value is a speed
@@ -180,22 +212,29 @@ class Data:
             else: # flow > 0
                 if _getSpeedError(flow, value, MAX_SPEED[type]) > 0:
                     return False # error 6 or 9
-                flowPerHour = flow * 3600 / updateInterval.seconds
+                flowPerHour = flow * _hourlyFactor(updateInterval)
                 if flowPerHour > maxFlowPerHour(value,  LENGTH[type]):
                     return False # error 8
         # no errors
         setattr(self, attr, value)
-        self.fixed.add(attr)
+        self.fixed |= _FIXED_MASK[attr]
         self.toBeWritten = True
         return True
 
 
     def unfix(self):
         """Resets all values which have been fixed to None."""
-        if len(self.fixed) > 0:
-            for attr in self.fixed:
-                setattr(self, attr, None)
-            self.fixed.clear()
+        fixed = self.fixed
+        if fixed:
+            if fixed & _FIXED_QPKW:
+                self.qPKW = None
+            if fixed & _FIXED_QLKW:
+                self.qLKW = None
+            if fixed & _FIXED_VPKW:
+                self.vPKW = None
+            if fixed & _FIXED_VLKW:
+                self.vLKW = None
+            self.fixed = 0
             self.toBeWritten = True
 
     def check(self, updateInterval, hasLKW=True):
@@ -203,29 +242,22 @@ class Data:
         Returns True If no errors where encountered.
         """
         noErrors = True
-        self.errorPKW = _getDataError(self.qPKW, self.vPKW, MAX_SPEED['PKW'],
-                                      LENGTH['PKW'], updateInterval)
-        if self.errorPKW > 0:
-            self.qPKW = None
+        hourlyFactor = _hourlyFactor(updateInterval)
+        self.errorPKW, dropFlow, dropSpeed = _getError(self.qPKW, self.vPKW, MAX_SPEED_PKW,
+                                                       LENGTH_PKW, hourlyFactor)
+        if dropSpeed:
+            if dropFlow:
+                self.qPKW = None
             self.vPKW = None
             noErrors = False
-        else:
-            self.errorPKW = _getSpeedError(self.qPKW, self.vPKW, MAX_SPEED['PKW'])
-            if self.errorPKW > 0 or self.qPKW == 0:
-                self.vPKW = None
-                noErrors = False
         if hasLKW:
-            self.errorLKW = _getDataError(self.qLKW, self.vLKW, MAX_SPEED['LKW'],
-                                          LENGTH['LKW'], updateInterval)
-            if self.errorLKW > 0:
-                self.qLKW = None
+            self.errorLKW, dropFlow, dropSpeed = _getError(self.qLKW, self.vLKW, MAX_SPEED_LKW,
+                                                           LENGTH_LKW, hourlyFactor)
+            if dropSpeed:
+                if dropFlow:
+                    self.qLKW = None
                 self.vLKW = None
                 noErrors = False
-            else:
-                self.errorLKW = _getSpeedError(self.qLKW, self.vLKW, MAX_SPEED['LKW'])
-                if self.errorLKW > 0 or self.qLKW == 0:
-                    self.vLKW = None
-                    noErrors = False
         return noErrors
 
 
@@ -247,26 +279,22 @@ class Data:
                 errorCode -= 10000
             else:
                 self.origDate = date
-            self.errorPKW = errorCode / 100
-            self.errorLKW = errorCode % 100
+            self.errorPKW, self.errorLKW = divmod(errorCode, 100)
     
     def _getQuality(self, date, hasLKW):
         """Calculates the quality of the item as an integer between 0 and 100."""
-        quality = 0
-        if (hasLKW):
-            qualIter = iter(_ATTRIBUTE_QUALITY.items())
-        else:
-            qualIter = iter(_ATTRIBUTE_QUALITY_NO_LKW.items())
-        for attr, maxQuality in qualIter:
-            if attr == "Date":
-                if date == self.origDate:
-                    quality += maxQuality
-            elif getattr(self, attr) != None or\
-                 (attr[0] == "v" and getattr(self, "q" + attr[1:]) == 0):
-                if attr in self.fixed:
-                    quality += maxQuality / 2
-                else:
-                    quality += maxQuality
+        qPKW, qLKW, vPKW, vLKW, dateQuality = _QUALITY_WEIGHTS if hasLKW else _QUALITY_WEIGHTS_NO_LKW
+        fixed = self.fixed
+        quality = dateQuality if date == self.origDate else 0
+        # a speed counts as present if the flow is zero
+        if self.qPKW is not None:
+            quality += qPKW[fixed & _FIXED_QPKW != 0]
+        if self.qLKW is not None:
+            quality += qLKW[fixed & _FIXED_QLKW != 0]
+        if self.vPKW is not None or self.qPKW == 0:
+            quality += vPKW[fixed & _FIXED_VPKW != 0]
+        if self.vLKW is not None or self.qLKW == 0:
+            quality += vLKW[fixed & _FIXED_VLKW != 0]
         return quality
 
     def toValues(self, date, hasLKW=True):
@@ -286,18 +314,34 @@ class Data:
         assert(type(date) == datetime)
         return dbSchema.EvalDetector.toValues(self,
                 date,
-                to_type_or_null(self.qPKW, round_int), 
-                to_type_or_null(self.qLKW, round_int),
-                to_type_or_null(self.vPKW, float),
-                to_type_or_null(self.vLKW, float),
+                _roundOrNull(self.qPKW),
+                _roundOrNull(self.qLKW),
+                _floatOrNull(self.vPKW),
+                _floatOrNull(self.vLKW),
+                int(self._getQuality(date, hasLKW)))
+
+    def toRow(self, date, hasLKW=True):
+        """Returns a tuple of (origID, detID, date, qPKW, qLKW, vPKW, vLKW, quality)
+        suitable for parameterized batch insertion or None if nothing is to be written"""
+        if not self.toBeWritten:
+            return None
+        origID = self.origID if self.hasOrigID() else None
+        return (origID, self.detID, date,
+                None if self.qPKW is None else int(round(self.qPKW)),
+                None if self.qLKW is None else int(round(self.qLKW)),
+                None if self.vPKW is None else float(self.vPKW),
+                None if self.vLKW is None else float(self.vLKW),
                 int(self._getQuality(date, hasLKW)))
        
 
     def __eq__(self, other):
-        if other == None:
+        if other is None or self.detID != other.detID:
             return False
-        return self.detID == other.detID and\
-            _isEqual(self.qPKW, other.qPKW) and\
+        values = (self.qPKW, self.qLKW, self.vPKW, self.vLKW)
+        otherValues = (other.qPKW, other.qLKW, other.vPKW, other.vLKW)
+        if values == otherValues:
+            return True
+        return _isEqual(self.qPKW, other.qPKW) and\
             _isEqual(self.qLKW, other.qLKW) and\
             _isEqual(self.vPKW, other.vPKW) and\
             _isEqual(self.vLKW, other.vLKW)
@@ -18,15 +18,18 @@ import os,sys
 import math
 from datetime import datetime, timedelta
 from collections import defaultdict
+from itertools import islice
+
+import numpy
 
 from . import database
 from . import setting
 from .setting import dbSchema
 from .detector import DetectorReader
 from .evalDetector import Data
-from .aggregateData import insertAggregated
+from .aggregateData import insertAggregated, flushAggregated
 from .database import as_time
-from .tools import geh, SAFE_ADD, SAFE_SUB, getIntervalEndsBetween
+from .tools import SAFE_ADD, SAFE_SUB, getIntervalEndsBetween
 
 IGNORE_REGION = True # extrapolate for all edges regardless of region
 TIME_OFFSETS = [timedelta(days=7), timedelta(days=14), timedelta(days=21)]
@@ -36,25 +39,35 @@ VALIDATION_WIDTH = 3 # maximum number of datapoints to use for validating the ex
 FLOW, SPEED = list(range(2))
 FEEDBACK_WIDTH = 2
 FEEDBACK_RANGE = list(range(-FEEDBACK_WIDTH,1)) # compute correction based on the primaryPrediction of the last 3 known measurements
+_BATCH_SIZE = 10000 # number of database rows converted at once
 # Debugging
 DEBUG = False
 EDGE_FILTER = ("" if not DEBUG else "and edge_id = 186390")
 
-def safe_avg(values, default=None):
-    actualValues = [v for v in values if v is not None]
-    if actualValues:
-        return sum(actualValues) / float(len(actualValues))
-    else:
-        return default
-
 def smooth_predictor(offsets):
     """create primary predictive function which uses the weekly periodicity of traffic
        (see constants TIME_OFFSETS and SMOOTHING_RANGE)"""
+    offsets = tuple(offsets)
+    targetTimes = {} # time -> list of times to average, shared by all edges
     def predictor(timeValues, time):
-        maybeValues = [timeValues.get(time - o) for o in offsets]
-        flows = [v[FLOW] for v in maybeValues if v is not None]
-        speeds = [v[SPEED] for v in maybeValues if v is not None]
-        return (safe_avg(flows), safe_avg(speeds))
+        targets = targetTimes.get(time)
+        if targets is None:
+            targets = targetTimes[time] = [time - o for o in offsets]
+        # average the available flows and speeds in a single pass
+        flowSum = speedSum = 0
+        flowCount = speedCount = 0
+        for t in targets:
+            value = timeValues.get(t)
+            if value is not None:
+                flow, speed = value
+                if flow is not None:
+                    flowSum += flow
+                    flowCount += 1
+                if speed is not None:
+                    speedSum += speed
+                    speedCount += 1
+        return (flowSum / flowCount if flowCount else None,
+                speedSum / speedCount if speedCount else None)
     return predictor
 
 
@@ -71,9 +84,12 @@ def get_correction(timeValues, knownTime, primaryPredictor):
 
 def feedback_predictor_absolute(primaryPredictor, knownTime):
     """correct extrapolation with the absolute extrapolation error for a known measurement"""
+    lastCorrection = [None, None] # the correction only depends on the edge (timeValues)
     def predictor(timeValues, time):
         primary = primaryPredictor(timeValues, time)
-        correction = get_correction(timeValues, knownTime, primaryPredictor)
+        if lastCorrection[0] is not timeValues:
+            lastCorrection[:] = [timeValues, get_correction(timeValues, knownTime, primaryPredictor)]
+        correction = lastCorrection[1]
         # make sure only valid data points are returned
         primaryData = Data(None, None, None, primary[FLOW], None, primary[SPEED], None)
         if primaryData.qPKW is not None and correction[FLOW] is not None:
@@ -86,18 +102,25 @@ def feedback_predictor_absolute(primaryPredictor, knownTime):
 
 def get_traffic_ids(conn, type, intervalEnds):
     result = {} # traffic_id -> time
-    times = ','.join(["%s '%s'" %(dbSchema.AggregateData.getTimeStampLabel(), t) for t in intervalEnds])
+    intervalEnds = sorted(set(intervalEnds))
+    params = None
+    if database.isPostgres(conn):
+        # pass the times as a single array parameter to keep the query text constant
+        timeFilter = "= ANY(%s)"
+        params = (intervalEnds,)
+    else:
+        timeFilter = "in (%s)" % ','.join(["%s '%s'" %(dbSchema.AggregateData.getTimeStampLabel(), t) for t in intervalEnds])
     intervalTable = dbSchema.AggregateData.getSchema(type)[0]
-    command = """select %s, %s from %s where %s in (%s)
+    command = """select %s, %s from %s where %s %s
                  %s
                 """ % (intervalTable.traffic_id,
                         intervalTable.traffic_time,
                         intervalTable,
                         intervalTable.traffic_time,
-                        times, 
+                        timeFilter,
                         dbSchema.Extrapolation.getTypePredicate(type))
     #print 'command:\n', command
-    rows =  database.execSQL(conn, command)
+    rows =  database.execSQL(conn, command, params=params)
     for id, time in rows:
         result[int(id)] = as_time(time)
     return result
@@ -116,28 +139,43 @@ def get_data_for_traffic_ids(conn, type, ids):
     edge_id = "edge_id"
     if dbSchema.Loop.region_choices[0] == "huainan":
         edge_id = "fbd_id"
+    params = None
+    if database.isPostgres(conn):
+        idFilter = "= ANY(%s)"
+        params = (list(ids.keys()),)
+    else:
+        idFilter = "in (%s)" % ','.join(map(str, ids.keys()))
     command = """
                 select %s, %s, %s, %s from %s
-                where %s in (%s)
+                where %s %s
                 %s
                 """ % (dbSchema.Tables.traffic.traffic_id,
                         edge_id,
                         q_column, v_column,
                         dataTable,
                         dbSchema.Tables.traffic.traffic_id,
-                        ','.join(map(str,list(ids.keys()))), EDGE_FILTER)
+                        idFilter, EDGE_FILTER)
     #print 'command:\n', command
-    rows =  database.execSQL(conn, command)
+    # stream the rows and convert them in batches to limit the memory usage
+    rows = database.execSQLIter(conn, command, "extrapolation_rows", params=params)
+    num_values = 0
     num_used_values = 0
-    for id, edge, q, v in rows:
-        if regionFilter is None or edge in regionFilter:
-            num_used_values += 1
-            if q is not None:
-                q = float(q)
-            if v is not None:
-                v = float(v)
-            result[edge][ids[id]] = (q,v)
-    print('Fetched %s values and kept %s for %s edges TEXTTEST_IGNORE' % (len(rows), num_used_values, len(result)))
+    while True:
+        batch = list(islice(rows, _BATCH_SIZE))
+        if not batch:
+            break
+        num_values += len(batch)
+        if regionFilter is not None:
+            batch = [row for row in batch if row[1] in regionFilter]
+        num_used_values += len(batch)
+        if batch:
+            trafficIDs, edges, flows, speeds = zip(*batch)
+            # convert the (possibly decimal) values column-wise, None becomes NaN and back
+            flows, speeds = [numpy.where(numpy.isnan(a), None, a).tolist()
+                             for a in (numpy.array(flows, dtype=float), numpy.array(speeds, dtype=float))]
+            for id, edge, q, v in zip(trafficIDs, edges, flows, speeds):
+                result[edge][ids[id]] = (q,v)
+    print('Fetched %s values and kept %s for %s edges TEXTTEST_IGNORE' % (num_values, num_used_values, len(result)))
     return result
 
 
@@ -155,34 +193,37 @@ def estimate_quality(lastKnown, data, intervalLength, predictor):
     predData = predict_at_times(times, data, predictor)
     # compare
     flowScale = 3600. / intervalLength.seconds
-    result = {}
-    for edge in data.keys():
-        result[edge] = safe_avg(
-                [pred_quality_at_time(edge, time, data, predData, flowScale) for time in times],
-                default=-1) # allows numerical comparison when retrieving data
-    return result
-
-def geh_to_quality(g):
-    """estimate quality based on GEH with a linear mapping:
-       GEH 0 -> quality 100
-       GEH 5 -> quality 50
-       GEH >= 10 -> quality 0"""
-    return max(0, 100 - 10*g) if g is not None else None
-
-
-def pred_quality_at_time(edge, time, data, predData, flowScale):
-    if not time in data[edge]:
-        return None
-    flow, speed = data[edge][time]
-    predFlow, predSpeed = predData[edge][time]
-    if flow is not None and predFlow is not None:
-        return geh_to_quality(geh(flow * flowScale, predFlow * flowScale))
-    elif speed is not None and predSpeed is not None:
-        # compute pseudo-GEH by mapping speeds onto a range of plausible flows
-        return geh_to_quality(geh(speed * 100, predSpeed * 100))
-    else:
-        return None
+    edges = list(data.keys())
+    # measured and predicted flows and speeds as edge x time arrays, NaN for missing
+    observed = numpy.full((2, len(edges), len(times)), numpy.nan)
+    predicted = numpy.full((2, len(edges), len(times)), numpy.nan)
+    for i, edge in enumerate(edges):
+        edgeData = data[edge]
+        edgePred = predData[edge]
+        for j, time in enumerate(times):
+            if time in edgeData:
+                observed[:, i, j] = edgeData[time]
+                predicted[:, i, j] = edgePred[time]
+    qualities = _geh_quality(observed[FLOW] * flowScale, predicted[FLOW] * flowScale,
+                             observed[SPEED] * 100, predicted[SPEED] * 100)
+    counts = (~numpy.isnan(qualities)).sum(axis=1)
+    sums = numpy.nansum(qualities, axis=1)
+    # -1 allows numerical comparison when retrieving data
+    return dict(zip(edges, [s / c if c > 0 else -1 for s, c in zip(sums.tolist(), counts.tolist())]))
 
+def _geh_quality(flow, predFlow, speed, predSpeed):
+    """Estimates the quality of the predictions (arrays with NaN for missing values)
+       from the GEH of the flows or, if flows are missing, of a pseudo-GEH of the speeds.
+       The GEH is mapped linearly: GEH 0 -> quality 100, GEH 5 -> quality 50,
+       GEH >= 10 -> quality 0. The result is NaN where nothing can be compared."""
+    def quality(m, c):
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            g = numpy.where(m + c == 0, 0, numpy.sqrt(2 * (m - c) ** 2 / (m + c)))
+        return numpy.maximum(0, 100 - 10 * g)
+    useFlow = ~numpy.isnan(flow) & ~numpy.isnan(predFlow)
+    useSpeed = ~useFlow & ~numpy.isnan(speed) & ~numpy.isnan(predSpeed)
+    return numpy.where(useFlow, quality(flow, predFlow),
+                       numpy.where(useSpeed, quality(speed, predSpeed), numpy.nan))
 
 def main(start, end, intervalLength, sourceType):
     """Main entry point of this module. """
@@ -192,13 +233,13 @@ def main(start, end, intervalLength, sourceType):
     offsets = set([o + i * intervalLength for o in TIME_OFFSETS for i in SMOOTHING_RANGE])
     predictor = feedback_predictor_absolute(smooth_predictor(offsets), start - intervalLength)
     # load historical data and latest measurements for validation
-    loadTimes = getIntervalEndsBetween(
-            start - feedbackInterval - intervalLength * VALIDATION_WIDTH, start, intervalLength)
+    loadTimes = set(getIntervalEndsBetween(
+            start - feedbackInterval - intervalLength * VALIDATION_WIDTH, start, intervalLength))
     for offset in TIME_OFFSETS:
-        loadTimes += getIntervalEndsBetween(
+        loadTimes.update(getIntervalEndsBetween(
                 start - offset - feedbackInterval - intervalLength * (SMOOTHING_WIDTH + VALIDATION_WIDTH), 
                 end   - offset + intervalLength * SMOOTHING_WIDTH, 
-                intervalLength)
+                intervalLength))
     trafficIDs = get_traffic_ids(conn, sourceType, loadTimes)
     data = get_data_for_traffic_ids(conn, sourceType, trafficIDs)
     # extrapolate data
@@ -214,6 +255,7 @@ def main(start, end, intervalLength, sourceType):
     qualitySum = 0
     writtenEntries = 0
     writtenEdges = set()
+    pending = []
     for time in times:
         for edge in predData.keys():
             flow, speed = predData[edge][time]
@@ -224,8 +266,9 @@ def main(start, end, intervalLength, sourceType):
                 writtenEdges.add(edge)
                 qualitySum += max(qual, 0)
         #print "inserting values for time %s" % time
-        insertAggregated(conn, "extrapolation", detReader, time, intervalLength)
+        insertAggregated(conn, "extrapolation", detReader, time, intervalLength, pending=pending)
+    flushAggregated(conn, "extrapolation", pending)
     avgQuality = (qualitySum / writtenEntries if writtenEntries > 0 else None)
     print('Extrapolated %s data points for %s edges with average quality %s TEXTTEST_IGNORE' % (
             writtenEntries, len(writtenEdges), avgQuality))
-    conn.close()
+    database.closeDatabaseConnection(conn)
@@ -17,7 +17,9 @@ Used by correctDetector
 import os,sys
 from datetime import datetime
 from collections import defaultdict
-from itertools import groupby, chain
+from functools import lru_cache
+
+import numpy
 
 from . import database
 from .detector import DetectorReader
@@ -29,28 +31,30 @@ QUALITY_FACTOR = {
         'fcd'  : 0.5, # we do not trust fcd quality fully, because only a fraction of all vehicles is equipped
         }
 
-class FusionValue:
-    def __init__(self):
-        self.initialized = False
-        self.weightedSum = 0
-        self.inverseQuality = 1.0 # 1 - quality
-        self.weight = 0
-
-    def add(self, value, qualityPercent, weight):
-        # stop fusioning if we already have a high quality value
-        if value is not None and self.inverseQuality > 0:
-            self.initialized = True
-            self.weightedSum += weight * value
-            self.weight += weight
-            self.inverseQuality *= (1 - qualityPercent / 100.0)
-
-    def getValueAndQualityPercent(self):
-        value = None
-        qualityPercent = None
-        if self.initialized and self.weight > 0:
-            value = self.weightedSum / self.weight
-            qualityPercent = 100 * (1 - self.inverseQuality)
-        return value, qualityPercent
+def _fuse(values, qualityPercent, starts):
+    """Fuses the values (NaN for missing) of each group starting at the given
+    indices. The value is the average weighted by quality and the quality
+    is 1 - product(1 - quality). Values after the first one reaching full
+    quality are ignored.
+    Returns a list of (value, qualityPercent) pairs, one for each group."""
+    valid = ~numpy.isnan(values)
+    factor = 1 - qualityPercent / 100.0
+    # stop fusioning if we already have a high quality value
+    index = numpy.arange(len(values))
+    stopIndex = numpy.minimum.reduceat(numpy.where(valid & (factor <= 0), index, len(values)), starts)
+    used = valid & (index <= numpy.repeat(stopIndex, numpy.diff(starts + [len(values)])))
+    weightedSum = numpy.add.reduceat(numpy.where(used, qualityPercent * values, 0), starts)
+    weight = numpy.add.reduceat(numpy.where(used, qualityPercent, 0), starts)
+    inverseQuality = numpy.multiply.reduceat(numpy.where(used, factor, 1), starts)
+    initialized = numpy.logical_or.reduceat(used, starts)
+    result = []
+    for init, wSum, w, invQ in zip(initialized.tolist(), weightedSum.tolist(),
+                                   weight.tolist(), inverseQuality.tolist()):
+        if init and w > 0:
+            result.append((wSum / w, 100 * (1 - invQ)))
+        else:
+            result.append((None, None))
+    return result
 
 
 def fusion(start, end, intervalLength):
@@ -63,40 +67,47 @@ def fusion(start, end, intervalLength):
         _fusion(conn, detReader, fusionTime, intervalLength)
         insertAggregated(conn, "fusion", detReader, fusionTime, intervalLength)
         fusionTime += intervalLength
-    conn.close()
-
+    database.closeDatabaseConnection(conn)
 
-def _fusion(conn, detReader, intervalEnd, intervalLength):
-    """XXX care must be taken not to average the fcd-count with the detector flow
 
-    Read traffic data from DB and add data to the given detReader.
-    Fusion according to quality"""
-    rows = {}
+@lru_cache(maxsize=None)
+def _fusionQuery():
+    """Returns the query for the loop and fcd data of an interval sorted by edge
+    and quality. The interval bounds are parameters (once for every source)."""
+    queries = []
     for source in ("loop", "fcd"):
         intervalTable, dataTable, qCol, vCol = dbSchema.AggregateData.getSchema(source)
-        query = """SELECT edge_id, '%s', %s, %s, d.quality
+        queries.append("""SELECT edge_id, '%s', %s, %s, d.quality
             FROM %s i, %s d WHERE i.%s = d.%s AND
-            i.%s > '%s' AND i.%s <= '%s'
-            ORDER BY edge_id, d.quality""" % (
+            i.%s > %%s AND i.%s <= %%s""" % (
             source, qCol, vCol, intervalTable, dataTable,
             intervalTable.traffic_id, intervalTable.traffic_id,
-            intervalTable.traffic_time, intervalEnd - intervalLength,
-            intervalTable.traffic_time, intervalEnd)
-        rows[source] = database.execSQL(conn, query)
+            intervalTable.traffic_time, intervalTable.traffic_time))
+    return "\n            UNION ALL ".join(queries) + "\n            ORDER BY 1, 5"
+
+
+def _fusion(conn, detReader, intervalEnd, intervalLength):
+    """XXX care must be taken not to average the fcd-count with the detector flow
+
+    Read traffic data from DB and add data to the given detReader.
+    Fusion according to quality"""
+    intervalStart = intervalEnd - intervalLength
+    rows = database.execSQL(conn, _fusionQuery(), params=[intervalStart, intervalEnd] * 2)
+    if rows:
+        edges, sources, flows, speeds, qualities = zip(*rows)
+        # group boundaries of the rows which are sorted by edge
+        starts = [0] + [i for i in range(1, len(edges)) if edges[i] != edges[i - 1]]
+        # since multiple fcd intervals may cover this fusion interval, we reduced their relative weight
+        adaptedQuality = numpy.array(qualities, dtype=float) * numpy.array([QUALITY_FACTOR[s] for s in sources])
+        isFcd = numpy.array(sources) == "fcd"
+        flowFusion = _fuse(numpy.where(isFcd, numpy.nan, numpy.array(flows, dtype=float)),  # fcd counts aren't flows
+                           adaptedQuality, starts)
+        speedFusion = _fuse(numpy.array(speeds, dtype=float), adaptedQuality, starts)
+    else:
+        starts = flowFusion = speedFusion = []
 
-    for edge, subrows in groupby(chain(rows["loop"], rows["fcd"]), lambda x:x[0]):
-        qFusion = FusionValue()
-        vFusion = FusionValue()
-        for edge, source, q, v, quality in subrows:
-            # since multiple fcd intervals may cover this fusion interval, we reduced their relative weight
-            adaptedQuality = quality * QUALITY_FACTOR[source]
-            adaptedWeight = adaptedQuality #* intervalLength.seconds / aggregation_interval
-            # using quality as fusion weight
-            if source != "fcd":  # fcd counts aren't flows
-                qFusion.add(q, adaptedQuality, adaptedWeight)
-            vFusion.add(v, adaptedQuality, adaptedWeight)
-        flow, flowQual = qFusion.getValueAndQualityPercent()
-        speed, speedQual = vFusion.getValueAndQualityPercent()
+    for start, (flow, flowQual), (speed, speedQual) in zip(starts, flowFusion, speedFusion):
+        edge = edges[start]
         # fix inconsistent values
         if flow == 0 and (speed or 0) > 0:
             flow = 1
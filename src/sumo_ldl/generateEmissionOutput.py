@@ -9,7 +9,7 @@
 # @author  Michael Behrisch
 # @date    2007-06-07
 """
-A XML ContentHandler which parses a SUMO emission file for NOx, CO2, CO, HC, PMx on
+A reader which parses a SUMO emission file (gzipped CSV) for NOx, CO2, CO, HC, PMx on
 edges and writes the results to the DB. Usually it is called from *.py.
 """
 import csv
@@ -17,11 +17,13 @@ import datetime
 import gzip
 import sys
 
+import numpy
+
 from . import setting
 from . import database
 
 class EmissionReader:
-    """ContentHandler for parsing SUMO emission outputs.
+    """Reader for SUMO emission outputs converted to CSV.
        It automatically parses the file given to the constructor."""
 
     def __init__(self, emissionfile, emissionInterpretation, emissionNormed):
@@ -31,29 +33,38 @@ class EmissionReader:
         if emissionInterpretation:
             for id in emissionInterpretation.keys():
                 self._detReader[id] = []
+        suffix = "_normed" if emissionNormed else "_abs"
         with gzip.open(emissionfile, "rt") as input:
-            for data in csv.DictReader(input, delimiter=";"):
-                interval_id = data['interval_id']
-                start = float(data['interval_begin'])
-                end = float(data['interval_end'])
+            reader = csv.reader(input, delimiter=";")
+            header = next(reader, None)
+            if header is None:
+                return
+            # column indices of the needed fields
+            iID, iBegin, iEnd, iEdge = [header.index(name) for name in
+                                        ('interval_id', 'interval_begin', 'interval_end', 'edge_id')]
+            iNOx, iCO, iPMx, iHC, iCO2 = [header.index("edge_%s%s" % (name, suffix)) for name in
+                                          ('NOx', 'CO', 'PMx', 'HC', 'CO2')]
+            for data in reader:
+                if not data:
+                    continue
+                interval_id = data[iID]
                 if interval_id not in self._emissionInterpretation:
                     print("WARNING: found unknown emission data interval '%s'" % interval_id, file=sys.stderr)
                     continue
-                self._aggregation = end - start
-                edge = data['edge_id']
-                CO = float(data['edge_CO_normed' if emissionNormed else 'edge_CO_abs'])
-                CO2 = float(data['edge_CO2_normed' if emissionNormed else 'edge_CO2_abs'])
-                HC = float(data['edge_HC_normed' if emissionNormed else 'edge_HC_abs'])
-                PMx = float(data['edge_PMx_normed' if emissionNormed else 'edge_PMx_abs'])
-                NOx = float(data['edge_NOx_normed' if emissionNormed else 'edge_NOx_abs'])
-                self._detReader[interval_id].append((edge, (NOx, CO, PMx, HC, CO2)))
+                self._aggregation = float(data[iEnd]) - float(data[iBegin])
+                self._detReader[interval_id].append((data[iEdge], (float(data[iNOx]), float(data[iCO]),
+                                                                   float(data[iPMx]), float(data[iHC]),
+                                                                   float(data[iCO2]))))
 
     def updateDB(self, intervalLength=None, base=None):
         if intervalLength is None:
             intervalLength = datetime.timedelta(seconds=self._aggregation)
         if self._emissionInterpretation:
+            conn = database.createOutputConnection()
+            edgeMap = setting.dbSchema.AggregateData.getSimulationEdgeMap(conn, True)
             for id, (time, trafficType, filename) in self._emissionInterpretation.items():
-                insertEmission(None, trafficType, self._detReader[id], time, intervalLength)
+                insertEmission(conn, trafficType, self._detReader[id], time, intervalLength, edgeMap)
+            database.closeDatabaseConnection(conn)
 
 
 def interpret_emission(emissionfile, intervalLength, emissionInterpretation, emissionNormed):
@@ -61,47 +72,50 @@ def interpret_emission(emissionfile, intervalLength, emissionInterpretation, emi
     emissionReader.updateDB(intervalLength)
 
 
-def insertEmission(conn, typeName, detReader, intervalEnd, intervalLength):
+def insertEmission(conn, typeName, detReader, intervalEnd, intervalLength, edgeMap=None):
     """Insert emission data into the database. The data is read from the
        given DetectorReader. If it is simulation data the edge ids are
-       taken as Navteq IDs instead of database road_section IDs and scenarios are taken into account."""
+       taken as Navteq IDs instead of database road_section IDs and scenarios are taken into account.
+       The simulation edge map is retrieved from the database if not given."""
     AggregateData = setting.dbSchema.AggregateData
+    doClose = False
     if conn == None:
         conn = database.createOutputConnection()
         doClose = True
     trafficIndex = None
-    values = {}
-    edgeMap = AggregateData.getSimulationEdgeMap(conn, True) # edgeMap['sumo_id']=['fbd_id1',....]
+    if edgeMap is None:
+        edgeMap = AggregateData.getSimulationEdgeMap(conn, True) # edgeMap['sumo_id']=['fbd_id1',....]
 
     # handle existing entry in traffic for the same type and time
     trafficIndex = AggregateData.getIntervalID(conn, typeName, intervalEnd, intervalLength, True)
     # process the detReader
     totalQuality = 0.
     unknownEdges = 0
-    for edge, emissions in detReader:
+    dbIndex = {} # database id -> row in the sums array
+    rowIndices = []
+    targetIndices = []
+    for row, (edge, emissions) in enumerate(detReader):
         if edge not in edgeMap:
             unknownEdges += 1
             if unknownEdges < 10:   # avoid to generate too much output 
                 sys.stderr.write("Ignoring data for unknown simulation edge '%s'\n" % edge) 
             continue
-        else:
-            edgeList = edgeMap[edge] # make edge a list of database-ids
-        for database_id in edgeList:
-            NOx, CO, PMx, HC, CO2, entryCount = values.get(database_id, (0, 0, 0, 0, 0, 0))  # todo: Elmar: should the absent data be filled with 0 or none? or no action?
-            # sum values for all groups
-            NOx += emissions[0]
-            CO += emissions[1]
-            PMx += emissions[2]
-            HC += emissions[3]
-            CO2 += emissions[4]
-            entryCount += 1
-            values[database_id] = (NOx, CO, PMx, HC, CO2, entryCount)
+        for database_id in edgeMap[edge]: # make edge a list of database-ids
+            rowIndices.append(row)
+            targetIndices.append(dbIndex.setdefault(database_id, len(dbIndex)))
     insertRows = []
-    for edge, (NOx, CO, PMx, HC, CO2, entryCount) in values.items():
-        if entryCount > 0:
-            insertRows.append((trafficIndex, edge, NOx, CO, PMx, HC, CO2, None))
+    if dbIndex:
+        # sum values for all groups
+        # todo: Elmar: should the absent data be filled with 0 or none? or no action?
+        emissions = numpy.array([e for edge, e in detReader], dtype=float)
+        sums = numpy.zeros((len(dbIndex), 5))
+        numpy.add.at(sums, targetIndices, emissions[rowIndices])
+        for database_id, (NOx, CO, PMx, HC, CO2) in zip(dbIndex, sums.tolist()):
+            insertRows.append((trafficIndex, database_id, NOx, CO, PMx, HC, CO2, None))
     # perform DB write
     if unknownEdges > 0:
         sys.stderr.write("Ignored data for %s unknown simulation edges'\n" % unknownEdges)
     if len(insertRows) > 0:
         AggregateData.insertEmissionData(conn, typeName, insertRows)
+    if doClose:
+        database.closeDatabaseConnection(conn)
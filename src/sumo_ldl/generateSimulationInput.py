@@ -12,9 +12,11 @@
 Functions for reading detector data from the database and generating
 appropriate triggers for the simulation. Usually it is called from runStep.py.
 """
-import os, sys, re
+import os, sys, re, gzip
 from datetime import timedelta
 from collections import defaultdict
+from operator import itemgetter
+from functools import lru_cache
 
 import sumolib
 
@@ -23,6 +25,17 @@ from .setting import dbSchema
 from .database import as_time
 from .tools import reversedMap
 
+_NAVTEQ_TIME = re.compile(r'\[\((\w*)\)\{(\w*)\}\]')
+_NAVTEQ_TOKEN = re.compile(r'([yMwdhms])(\d+)')
+_FLOW = '        <flow begin="%s" end="%s" %s%s%s\n'
+_FLOW_EXTRAPOLATION = '        <flow begin="%s" end="%s" %s%s%s<!-- extrapolation -->\n'
+_REROUTER = """    <rerouter id="rerouter_%s" edges="%s">
+        <interval begin="%s" end="%s">
+            <closingReroute id="%s"/>
+        </interval>
+    </rerouter>
+"""
+
 class ListWrapper(list):
     """wrapper for normal python lists which limits the output when printing"""
     def __init__(self, l, toPrint=5):
@@ -39,29 +52,59 @@ class ListWrapper(list):
 
 
 def _writeCalibrators(filename, flowMap, routeInterval, begin, calibratorInterval, logfile, collectRouteInfo):
-    """Writes the time dependent data to the individual files."""
-    with sumolib.openz(filename, 'w') as f:
+    """Writes the time dependent data (sorted by time for every edge) to the individual files.
+    Each calibrator is collected and written in one go since every write
+    to the compressed stream is costly."""
+    startSeconds = {} # (time, aggInterval) -> start second, the times are the same for most edges
+    if filename.endswith(".gz"):
+        # the file is read only once by the simulation, so fast compression pays off
+        f = gzip.open(filename, 'wt', compresslevel=1, encoding="utf8")
+    else:
+        f = sumolib.openz(filename, 'w')
+    with f:
         sumolib.xml.writeHeader(f, root="additional")
         for edge, flowsteps in flowMap.items():
             routeProbe = (' routeProbe="routedist_%s"' % edge) if collectRouteInfo else ""
-            print('    <calibrator id="calibrator_%s" lane="%s_0" pos="0" freq="%s" friendlyPos="x" output="%s"%s>' % (
-                edge, edge, calibratorInterval, logfile, routeProbe), file=f)
-            for time, aggInterval, flow, speed, quality, type in sorted(flowsteps):
+            parts = ['    <calibrator id="calibrator_%s" lane="%s_0" pos="0" freq="%s" friendlyPos="x" output="%s"%s>\n' % (
+                edge, edge, calibratorInterval, logfile, routeProbe)]
+            # calibrator prefers the dynamic route distribution (with interval time as suffix) 
+            # and uses the static route distribution as fallback
+            flowEnd = 'type="vtypedist" route="routedist_%s"/>' % edge
+            for time, aggInterval, flow, speed, quality, type in flowsteps:
                 if speed is None: #or speed > 120.:  # todo: filter very low and very high speeds especially at late night in the data correction code (except of highway)
                     speed_attr = '' # disable speed calibration if speed is not known (see METriggeredCalibrator::execute())
                 else:
                     speed_attr = 'speed="%s" ' % (speed / 3.6)
                 flow_attr = '' if flow is None else 'vehsPerHour="%s" ' % flow # disable flow calibration if flow is not known
-                startSecond = tools.daySecond(time - timedelta(seconds=aggInterval), begin)
-                comment = '<!-- extrapolation -->' if type == 'extrapolation' else ''
-                # calibrator prefers the dynamic route distribution (with interval time as suffix) 
-                # and uses the static route distribution as fallback
-                print('        <flow begin="%s" end="%s" %s%stype="vtypedist" route="routedist_%s"/>%s'
-                       % (startSecond, startSecond + aggInterval, flow_attr, speed_attr, edge, comment), file=f)
-            print("    </calibrator>", file=f)
+                startSecond = startSeconds.get((time, aggInterval))
+                if startSecond is None:
+                    startSecond = tools.daySecond(time - timedelta(seconds=aggInterval), begin)
+                    startSeconds[(time, aggInterval)] = startSecond
+                parts.append((_FLOW_EXTRAPOLATION if type == 'extrapolation' else _FLOW)
+                             % (startSecond, startSecond + aggInterval, flow_attr, speed_attr, flowEnd))
+            parts.append("    </calibrator>\n")
+            f.write("".join(parts))
         print("</additional>", file=f)
 
 
+def _sortTrafficData(trafficData):
+    """Sorts the entries of every edge by time keeping only the first entry for each time.
+    Returns the edges with flows and the number of entries per type."""
+    flowEdges = set()
+    typeCounts = defaultdict(int)
+    for id, flowsteps in trafficData.items():
+        kept = []
+        for step in sorted(flowsteps, key=itemgetter(0)): # stable, so the first entry stays first
+            if kept and kept[-1][0] == step[0]:
+                continue
+            kept.append(step)
+            typeCounts[step[5]] += 1
+            if step[2] is not None:
+                flowEdges.add(id)
+        trafficData[id] = kept
+    return flowEdges, typeCounts
+
+
 def generateCalibrators(directory, simBegin, forecastStart, simEnd, simOutputDir):
     """Main function of this module. Parses the detector file,
     reads the DB and calls the other functions."""
@@ -73,37 +116,45 @@ def generateCalibrators(directory, simBegin, forecastStart, simEnd, simOutputDir
     # when running in historic mode, ignore measurements from the future
     discardFutureMeasurements = setting.getDetectorOptionBool("historic")
     # query DB for all types but use only the first row for each (time,edge)
-    # (extrapolation comes last in sort order)
-    trafficData = defaultdict(lambda:[]) # navteqID -> [(time, interval, flow, speed, quality, type), ...]
+    # (getTypedTrafficValues should return rows sorted by edge and time with the types
+    # of the same time in the given order, other orders are sorted afterwards)
+    trafficData = defaultdict(list) # navteqID -> [(time, interval, flow, speed, quality, type), ...]
     conn = database.createDatabaseConnection()
     rows = dbSchema.GenerateSimulationInput.getTypedTrafficValues(conn, types, simBegin, simEnd, 
             setting.getLoopOption("qualityThreshold"),
             setting.getLoopOptionMinutes("aggregate").seconds,
             setting.timeline)
-    typeCounts = defaultdict(lambda:0)
-    covered_times = defaultdict(set)
+    typeCounts = defaultdict(int)
+    lastTime = {} # navteqID -> time of the last used entry
+    unsorted = False
     flowEdges = set()
+    rowCount = 0
+    edges = setting.edges
     for id, time, interval, flow, speed, quality, type in rows:
-        if not id in setting.edges:
+        rowCount += 1
+        if id not in edges:
             continue
-        time = database.as_time(time)
+        time = as_time(time)
         if flow is None and speed is None:
             print("Warning: ignoring invalid entry %s" % ((id, time, interval, flow, speed, quality, type),), file=sys.stderr)
             continue
-        time = as_time(time)
         if discardFutureMeasurements and type != 'extrapolation' and time > forecastStart:
             continue
         if flow is None and not doSpeedCalibration:
             continue
-        if time in covered_times[id]:
+        if lastTime.get(id) == time:
             continue # real measurement is known, do not used extrapolation
+        if id in lastTime and time < lastTime[id]:
+            unsorted = True
         if flow is not None:
             flowEdges.add(id)
-        covered_times[id].add(time)
+        lastTime[id] = time
         typeCounts[type] += 1
         trafficData[id].append((time, interval, flow, speed, quality, type))
-    print("Fetched %s entries for %s edges types=%s TEXTTEST_IGNORE" % (len(rows), len(trafficData), dict(typeCounts)))
-    conn.close()
+    if unsorted:
+        flowEdges, typeCounts = _sortTrafficData(trafficData)
+    print("Fetched %s entries for %s edges types=%s TEXTTEST_IGNORE" % (rowCount, len(trafficData), dict(typeCounts)))
+    database.closeDatabaseConnection(conn)
     # write calibrators
     calibratorAdd = os.path.join(directory, "calibrators.add.xml.gz")
     _writeCalibrators(calibratorAdd, 
@@ -113,77 +164,74 @@ def generateCalibrators(directory, simBegin, forecastStart, simEnd, simOutputDir
     return [calibratorAdd], ListWrapper(flowEdges)
 
 
+def _navteqTokens(spec, dateparts):
+    """yields (datepart, amount) for the leading tokens of the navteq time spec
+    which follow the order of the given dateparts"""
+    last = -1
+    for datepart, amount in _NAVTEQ_TOKEN.findall(spec):
+        index = dateparts.find(datepart)
+        if index <= last:
+            return
+        last = index
+        yield datepart, int(amount)
+
+
+@lru_cache(maxsize=4096)
 def calculateInterval(begin, end, navteqTime):
     """
     Calculate the intersection of the time interval(s) given in the navteq description
     with the interval described by (begin, end). Returns the interval as pair or
     None on empty intersection or navteq parsing failure.
     """
-    match = re.match('\[\((\w*)\)\{(\w*)\}\]', navteqTime)
+    match = _NAVTEQ_TIME.match(navteqTime)
     if not match or len(match.groups()) < 2:
         print("Warning! Unsupported NavTeq time format %s." % navteqTime, file=sys.stderr)
         return None
-    navteqBegin = match.group(1)
     parsedBegin = begin + timedelta(0)
-    for datepart in ["y", "M", "d", "h", "m", "s"]: 
-        if datepart == navteqBegin[0]:
-            idx = 1
-            while idx < len(navteqBegin) and navteqBegin[idx] in "0123456789":
-                idx += 1
-            amount = int(navteqBegin[1:idx])
-            if idx < len(navteqBegin):
-                navteqBegin = navteqBegin[idx:]
-            if datepart == "y":
-                parsedBegin = parsedBegin.replace(amount) 
-            elif datepart == "M":
+    for datepart, amount in _navteqTokens(match.group(1), "yMdhms"):
+        if datepart == "y":
+            parsedBegin = parsedBegin.replace(amount) 
+        elif datepart == "M":
+            maxDay = [0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+            if parsedBegin.year % 4 == 0 and parsedBegin.year % 100 != 0:
+                maxDay[2] = 29
+            targetDay = min(parsedBegin.day, maxDay[amount])
+            parsedBegin = parsedBegin.replace(month=amount, day=targetDay) 
+        elif datepart == "d":
+            parsedBegin = parsedBegin.replace(day=amount) 
+        elif datepart == "h":
+            parsedBegin = parsedBegin.replace(hour=amount) 
+        elif datepart == "m":
+            parsedBegin = parsedBegin.replace(minute=amount) 
+        elif datepart == "s":
+            parsedBegin = parsedBegin.replace(second=amount) 
+    parsedEnd = parsedBegin + timedelta(0)
+    for datepart, amount in _navteqTokens(match.group(2), "yMwdhms"):
+        if datepart == "y":
+            parsedEnd = parsedEnd.replace(parsedEnd.year + amount) 
+        elif datepart == "M":
+            years = amount // 12
+            targetMonth = parsedEnd.month + amount % 12
+            if targetMonth > 12:
+                targetMonth -= 12
+                years += 1
+            parsedEnd = parsedEnd.replace(parsedEnd.year + years) 
+            if targetMonth != parsedEnd.month:
                 maxDay = [0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
-                if parsedBegin.year % 4 == 0 and parsedBegin.year % 100 != 0:
+                if parsedEnd.year % 4 == 0 and parsedEnd.year % 100 != 0:
                     maxDay[2] = 29
-                targetDay = min(parsedBegin.day, maxDay[amount])
-                parsedBegin = parsedBegin.replace(month=amount, day=targetDay) 
-            elif datepart == "d":
-                parsedBegin = parsedBegin.replace(day=amount) 
-            elif datepart == "h":
-                parsedBegin = parsedBegin.replace(hour=amount) 
-            elif datepart == "m":
-                parsedBegin = parsedBegin.replace(minute=amount) 
-            elif datepart == "s":
-                parsedBegin = parsedBegin.replace(second=amount) 
-    navteqInterval = match.group(2)
-    parsedEnd = parsedBegin + timedelta(0)
-    for datepart in ["y", "M", "w", "d", "h", "m", "s"]: 
-        if datepart == navteqInterval[0]:
-            idx = 1
-            while idx < len(navteqInterval) and navteqInterval[idx] in "0123456789":
-                idx += 1
-            amount = int(navteqInterval[1:idx])
-            if idx < len(navteqInterval):
-                navteqInterval = navteqInterval[idx:]
-            if datepart == "y":
-                parsedEnd = parsedEnd.replace(parsedEnd.year + amount) 
-            elif datepart == "M":
-                years = amount / 12
-                targetMonth = parsedEnd.month + amount % 12
-                if targetMonth > 12:
-                    targetMonth -= 12
-                    years += 1
-                parsedEnd = parsedEnd.replace(parsedEnd.year + years) 
-                if targetMonth != parsedEnd.month:
-                    maxDay = [0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
-                    if parsedEnd.year % 4 == 0 and parsedEnd.year % 100 != 0:
-                        maxDay[2] = 29
-                    targetDay = min(parsedEnd.day, maxDay[targetMonth])
-                    parsedEnd = parsedEnd.replace(month=targetMonth, day=targetDay) 
-            elif datepart == "w":
-                parsedEnd += timedelta(weeks=amount) 
-            elif datepart == "d":
-                parsedEnd += timedelta(days=amount)
-            elif datepart == "h":
-                parsedEnd += timedelta(hours=amount)
-            elif datepart == "m":
-                parsedEnd += timedelta(minutes=amount) 
-            elif datepart == "s":
-                parsedEnd += timedelta(seconds=amount)
+                targetDay = min(parsedEnd.day, maxDay[targetMonth])
+                parsedEnd = parsedEnd.replace(month=targetMonth, day=targetDay) 
+        elif datepart == "w":
+            parsedEnd += timedelta(weeks=amount) 
+        elif datepart == "d":
+            parsedEnd += timedelta(days=amount)
+        elif datepart == "h":
+            parsedEnd += timedelta(hours=amount)
+        elif datepart == "m":
+            parsedEnd += timedelta(minutes=amount) 
+        elif datepart == "s":
+            parsedEnd += timedelta(seconds=amount)
     if parsedEnd < parsedBegin:
         parsedEnd, parsedBegin = parsedBegin, parsedEnd 
     if parsedEnd < begin or parsedBegin > end:
@@ -207,44 +255,52 @@ def handleBlockings(directory, intervalBegin, intervalEnd, testBlockingRows = []
 
     blockedSections = {}
     if len(rows) == 0:
+        database.closeDatabaseConnection(conn)
         return []
 
     reverseEdgeMap = reversedMap(dbSchema.AggregateData.getSimulationEdgeMap(conn)) # for 1-to-1 edge relation, not 1-to-more edge relations
+    # find vaporizers on blocked edges
+    vaporizers = []
+    for edge_id, validity_period in rows:
+        interval = calculateInterval(intervalBegin, intervalEnd, validity_period)
+        if interval:
+            edge_id_sim = reverseEdgeMap.get(edge_id, edge_id) # for 1-to-1 edge relation
+            begin, end = interval
+            beginSecond = tools.daySecond(begin)
+            endSecond = tools.daySecond(end, beginSecond)
+            vaporizers.append((edge_id_sim, beginSecond, endSecond))
+            blockedSections[edge_id] = (beginSecond, endSecond, edge_id_sim)
+
+    # find edges leading to blocked sections, all database work is done before writing
+    inEdges = defaultdict(list) # blocked edge -> edges leading to it
+    if blockedSections:
+        rows = database.execSQL(conn, 
+                """ SELECT %s, %s FROM %s WHERE %s IN (%s)""" % (
+                    dbSchema.Tables.edge_connection.in_edge,
+                    dbSchema.Tables.edge_connection.out_edge,
+                    dbSchema.Tables.edge_connection,
+                    dbSchema.Tables.edge_connection.out_edge,
+                    ", ".join(map(str, blockedSections))))
+        for inEdge, outEdge in rows:
+            inEdges[outEdge].append(inEdge)
+    database.closeDatabaseConnection(conn)
+
     numRerouters = 0
     additional = os.path.join(directory, "blockings.add.xml")
-    with open(additional, 'w') as f:
-        print("<add>", file=f)
-        # add vaporizers on blocked edges
-        for edge_id, validity_period in rows:
-            interval = calculateInterval(intervalBegin, intervalEnd, validity_period)
-            if interval:
-                edge_id_sim = reverseEdgeMap.get(edge_id, edge_id) # for 1-to-1 edge relation
-                begin, end = interval
-                beginSecond = tools.daySecond(begin)
-                endSecond = tools.daySecond(end, beginSecond)
-                print('    <vaporizer id="%s" begin="%s" end="%s"/>'\
-                            % (edge_id_sim, beginSecond, endSecond), file=f)
-                blockedSections[edge_id] = (beginSecond, endSecond, edge_id_sim)
-
-        # put rerouters on edges leading to blocked sections
-        for edge_id, blocking in list(blockedSections.items()):
-            rows = database.execSQL(conn, 
-                    """ SELECT %s FROM %s WHERE %s=%s""" % (
-                        dbSchema.Tables.edge_connection.in_edge,
-                        dbSchema.Tables.edge_connection,
-                        dbSchema.Tables.edge_connection.out_edge,
-                        edge_id))
-
-            rerouter_edges = [reverseEdgeMap.get(e[0],e[0]) for e in rows if not e[0] in blockedSections] # for 1-to-1 edge relation
-            if len(rerouter_edges) > 0:
-                numRerouters += 1
-                edge_id_sim = reverseEdgeMap.get(edge_id, edge_id) # for 1-to-1 edge relation
-                print("""    <rerouter id="rerouter_%s" edges="%s">
-        <interval begin="%s" end="%s">
-            <closingReroute id="%s"/>
-        </interval>
-    </rerouter>""" % ((edge_id_sim, ' '.join(rerouter_edges)) + blocking), file=f)
+    parts = ["<add>\n"]
+    for vaporizer in vaporizers:
+        parts.append('    <vaporizer id="%s" begin="%s" end="%s"/>\n' % vaporizer)
 
-        print("</add>", file=f)
+    # put rerouters on edges leading to blocked sections
+    for edge_id, blocking in blockedSections.items():
+        rerouter_edges = [reverseEdgeMap.get(e,e) for e in inEdges[edge_id] if not e in blockedSections] # for 1-to-1 edge relation
+        if len(rerouter_edges) > 0:
+            numRerouters += 1
+            edge_id_sim = reverseEdgeMap.get(edge_id, edge_id) # for 1-to-1 edge relation
+            beginSecond, endSecond, closedEdge = blocking
+            parts.append(_REROUTER % (edge_id_sim, ' '.join(rerouter_edges), beginSecond, endSecond, closedEdge))
+    parts.append("</add>\n")
+    with open(additional, 'w') as f:
+        f.write("".join(parts))
     print("Blocked %s edges and placed %s rerouters." % (len(blockedSections), numRerouters))
     return [additional]
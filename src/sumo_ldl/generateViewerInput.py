@@ -10,7 +10,7 @@
 # @author  Michael Behrisch
 # @date    2007-06-07
 """
-A XML ContentHandler which parses a SUMO dumpfile for speeds and flows on
+A reader which parses a SUMO dumpfile (gzipped CSV) for speeds and flows on
 edges and writes the results to a plain text file for Elmar's Viewer and
 to the DB. Usually it is called from runStep.py.
 """
@@ -24,73 +24,95 @@ from optparse import OptionParser
 from .detector import DetectorReader
 from .aggregateData import insertAggregated
 from . import setting
+from . import database
 
 
 class DumpReader:
-    """ContentHandler for parsing SUMO dumps.
+    """Reader for SUMO dumps converted to CSV.
        It automatically parses the file given to the constructor."""
 
     def __init__(self, dumpfile, dumpInterpretation):
         self._dumpInterpretation = dumpInterpretation
-        self._out = {} # file objects for outfiles for the dumpID
+        self._out = {} # file object and buffered lines of the outfile for the dumpID
         self._detReader = {} # one detector reader for every dumpID
         self._aggregation = None # the length of the currently parsed interval in seconds
         if dumpInterpretation:
             for id, (time, traffic_type, filename) in dumpInterpretation.items():
                 if filename is not None:
-                    out = open(filename, 'w')
-                    print(time.strftime("%Y-%m-%d %H:%M"), file=out)
-                    print("Navtech-ID\tm/s\tveh/h", file=out)
-                    self._out[id] = out
+                    self._out[id] = (open(filename, 'w', buffering=1<<20),
+                                     [time.strftime("%Y-%m-%d %H:%M\n"), "Navtech-ID\tm/s\tveh/h\n"])
                 self._detReader[id] = DetectorReader()
+        # transform simulation speeds (m/s) into db speeds (m/s or km/h) depending on dbSchema
+        speedFactor = 3.6 / setting.dbSchema.EvalDetector.kmhMultiplier
         with gzip.open(dumpfile, "rt") as input:
-            for data in csv.DictReader(input, delimiter=";"):
-                interval_id = data['interval_id']
-                start = float(data['interval_begin'])
-                end = float(data['interval_end'])
+            reader = csv.reader(input, delimiter=";")
+            header = next(reader, [])
+            if header:
+                iID, iBegin, iEnd = [header.index(name) for name in
+                                     ('interval_id', 'interval_begin', 'interval_end')]
+                columns = DumpReader.getEdgeColumns(header)
+            interval = None # (begin, end) strings of the current interval
+            interpretEdge = DumpReader.interpretEdge
+            for data in reader:
+                if not data:
+                    continue
+                interval_id = data[iID]
                 if interval_id not in dumpInterpretation:
                     print("WARNING: found unknown dump interval '%s'" % interval_id, file=sys.stderr)
                     continue
-                self._aggregation = end - start
-                edge, num_vehs, speed = DumpReader.interpretEdge(data)
-                if num_vehs > 0 and not 'Added' in edge and speed is not None:
+                if interval != (data[iBegin], data[iEnd]):
+                    interval = (data[iBegin], data[iEnd])
+                    self._aggregation = float(data[iEnd]) - float(data[iBegin])
+                edge, num_vehs, speed = interpretEdge(data, columns)
+                if num_vehs > 0 and speed is not None and 'Added' not in edge:
                     if interval_id in self._out:
-                        print("%s\t%i\t%i" % (
-                                edge, speed, num_vehs * 3600 / self._aggregation), file=self._out[interval_id])
+                        self._out[interval_id][1].append("%s\t%i\t%i\n" % (
+                                edge, speed, num_vehs * 3600 / self._aggregation))
                     detReader = self._detReader[interval_id]
                     if not detReader.hasEdge(edge):
                         detReader.addGroup(0, edge)
                         detReader.addDetector(edge, 0, edge)
-                    # transform simulation speeds (m/s) into db speeds (m/s or km/h) depending on dbSchema
-                    detReader.addFlow(edge, num_vehs, speed * 3.6 / setting.dbSchema.EvalDetector.kmhMultiplier)
-        for out in self._out.values():
+                    detReader.addFlow(edge, num_vehs, speed * speedFactor)
+        for out, lines in self._out.values():
+            out.write("".join(lines))
             out.close()
 
     def updateDB(self, intervalLength=None, base=None):
         if intervalLength is None:
             intervalLength = datetime.timedelta(seconds=self._aggregation)
         if self._dumpInterpretation:
+            conn = database.createOutputConnection()
+            edgeMap = setting.dbSchema.AggregateData.getSimulationEdgeMap(conn, True)
             for id, (time, trafficType, filename) in self._dumpInterpretation.items():
-                insertAggregated(None, trafficType, 
+                insertAggregated(conn, trafficType, 
                         self._detReader[id], time, intervalLength, True,
-                        flowScale=3600/intervalLength.seconds)
+                        flowScale=3600/intervalLength.seconds, edgeMap=edgeMap)
+            database.closeDatabaseConnection(conn)
+
 
+    @staticmethod
+    def getEdgeColumns(header):
+        """return the indices of the columns needed by interpretEdge,
+        None for the optional vaporized column if it is missing"""
+        return tuple([header.index(name) for name in ('edge_id', 'edge_speed', 'edge_departed', 'edge_entered')] +
+                     [header.index('edge_vaporized') if 'edge_vaporized' in header else None])
 
     @staticmethod
-    def interpretEdge(attrs):
-        """return edge_id, vehPerHour, speed for the given edge attributes"""
-        edge = attrs['edge_id']
-        if not attrs.get('edge_speed'):
+    def interpretEdge(row, columns):
+        """return edge_id, vehPerHour, speed for the given csv row and column indices"""
+        iEdge, iSpeed, iDeparted, iEntered, iVaporized = columns
+        edge = row[iEdge]
+        if not row[iSpeed]:
             return edge, 0, None
-        speed = float(attrs['edge_speed'])
+        speed = float(row[iSpeed])
         # departed + entered = driving + arrived + left (left includes vaporized due to calibration)
         # vehicles removed due to calibration should not be counted here
         # 1) departed + entered - vaporized  <-> detector at the start of the edge
         # 2) arrived + left - vaporized      <-> detector at the end of the edge
         # calibrators use definition 1 so we do the same here for consistency
-        num_vehs = float(attrs['edge_departed']) + float(attrs['edge_entered'])
-        if attrs.get('edge_vaporized'):
-            num_vehs -= float(attrs['edge_vaporized'])
+        num_vehs = float(row[iDeparted]) + float(row[iEntered])
+        if iVaporized is not None and row[iVaporized]:
+            num_vehs -= float(row[iVaporized])
         if speed < 0:
             print("Warning: invalid speed '%s' for edge '%s' when parsing dump" % (speed, edge), file=sys.stderr)
             speed = None
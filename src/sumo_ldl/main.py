@@ -16,10 +16,14 @@ Main entry point of the library for time triggered repeated tasks in the DSP sim
 """
 
 import os, sys, traceback, optparse, time, urllib.request, urllib.parse, urllib.error
+import atexit, queue, threading
 from datetime import datetime, timedelta
 
 from . import setting, tools
 
+# default timeout in seconds for a single PSM request (option "timeout" in section PSM)
+_PSM_TIMEOUT = 10
+
 # loop to to config section
 TYPE2SECTION = {
         'simulation' : 'Loop',
@@ -48,6 +52,8 @@ def _init(dbSchema, loopDir):
     optParser.add_option("--no-correction", dest="do_correction", default=True,
             action="store_false", help="Skip detector correction (if already handled by another process)")
     optParser.add_option("--clean", default=False, action="store_true", help="clean tables")
+    optParser.add_option("--step-barrier", dest="step_barrier", default=False, action="store_true",
+            help="wait for a byte on stdin before every step (used by replay_loops)")
     (options, args) = optParser.parse_args()
     
     # Reads the settings and processes them to initialize the loop.
@@ -70,6 +76,8 @@ def _init(dbSchema, loopDir):
         from . import simulationRun
         mainFunc = simulationRun.main
         repeatTime = setting.getLoopOptionMinutes("repeat")
+    if options.step_barrier:
+        mainFunc = _withStepBarrier(mainFunc)
 
     repeatMin = repeatTime.seconds / 60
     # repeat time < 1 day else ...
@@ -85,10 +93,10 @@ def _init(dbSchema, loopDir):
         options.log = os.path.join(setting.getLoopOption("region"), 
                                             "log_%s_%s_%s.txt" % (options.typeOfLoop, options.scenario,
                                             setting.startTime.strftime("%Y_%m_%d_%H-%M-%S")))
-    dirName = os.path.join(loopDir, os.path.dirname(options.log))
-    if dirName != '' and not os.path.exists(dirName):
-        os.makedirs(dirName)
-    outf = open(os.path.join(loopDir, os.path.normpath(options.log)), "w")
+    logPath = os.path.join(loopDir, os.path.normpath(options.log))
+    if os.path.dirname(logPath):
+        os.makedirs(os.path.dirname(logPath), exist_ok=True)
+    outf = open(logPath, "w", buffering=1 << 16)
     sys.stdout = tools.TeeFile(sys.__stdout__, outf)
     print("Log file: %s TEXTTEST_IGNORE" % options.log)
     
@@ -97,6 +105,27 @@ def _init(dbSchema, loopDir):
 
     return mainFunc, repeatTime, options.typeOfLoop, options
 
+def _withStepBarrier(mainFunc):
+    """Wraps mainFunc such that every step waits for a byte on stdin.
+    Exits when stdin is closed, i.e. the controlling process is gone."""
+    def step(*args):
+        # the controller waits for the output of the previous step before sending the next byte
+        sys.stdout.flush()
+        if not sys.stdin.buffer.read(1):
+            # os._exit skips the atexit handlers
+            _drainPsmQueue()
+            sys.stdout.flush()
+            os._exit(0)
+        return mainFunc(*args)
+    return step
+
+def _sleepUntil(deadline):
+    """sleeps until time.monotonic() reaches the deadline"""
+    remaining = deadline - time.monotonic()
+    while remaining > 0:
+        time.sleep(remaining)
+        remaining = deadline - time.monotonic()
+
 def _startLoop(mainFunc, repeat, loopType, loopDir, options):
     """
     Starts the loop with the parameters and options read from 
@@ -122,8 +151,7 @@ Executing first step immediately""" % (datetime.now(), setting.startTime, repeat
             
         # loop
         try: # ToDo: Make this try block obsolete by holding the called mainFunc responsible for all exception handling
-            psmMessage = "&st=1&stDes=Loop started"
-            sendMessageToPsm(psmMessage, loopType)
+            sendMessageToPsm(1, "Loop started", loopType)
             # STYLE: Gibt es hier einen besonderen Grund warum der Zugriff auf die "main"-Funktionen
             # nicht ueber Vererbung impl. wurde? Ist naemlich ziemlich verschachtelt!
             doContinue = mainFunc(True, False, loopDir, options)
@@ -135,26 +163,24 @@ Executing first step immediately""" % (datetime.now(), setting.startTime, repeat
                 waitTime = setting.startTime + delay - datetime.now()
                 if tools.dayMinute(setting.startTime) == 0:
                     print("Starting new day")
-                    psmMessage = "&st=1&stDes=Loop Run completed, StartedTime=" + str(startedTime) + ", Waited=" + str(waitTime)
-                    sendMessageToPsm(psmMessage, loopType)
+                    sendMessageToPsm(1, "Loop Run completed, StartedTime=" + str(startedTime) + ", Waited=" + str(waitTime), loopType)
                     doContinue = mainFunc(False, True, loopDir, options)
                 else:
                     if waitTime > timedelta(0):
-                        print("Waiting %i seconds till begin." % waitTime.seconds)
-                        psmMessage = "&st=1&stDes=Loop Run completed, StartedTime=" + str(startedTime) + ", Waiting=" + str(waitTime)
-                        sendMessageToPsm(psmMessage, loopType)
-                        time.sleep(waitTime.seconds)
+                        # the deadline is monotonic so the time spent on the PSM message and clock changes do not matter
+                        deadline = time.monotonic() + waitTime.total_seconds()
+                        print("Waiting %i seconds till begin." % waitTime.total_seconds())
+                        sendMessageToPsm(1, "Loop Run completed, StartedTime=" + str(startedTime) + ", Waiting=" + str(waitTime), loopType)
+                        _sleepUntil(deadline)
                     else:
                         print("Delayed by %s!" % (-waitTime), 'TEXTTEST_IGNORE')
-                        psmMessage = "&st=0&stDes=Loop Run completed, StartedTime=" + str(startedTime) + ", Delayed=" + str(-waitTime)
-                        sendMessageToPsm(psmMessage, loopType)
+                        sendMessageToPsm(0, "Loop Run completed, StartedTime=" + str(startedTime) + ", Delayed=" + str(-waitTime), loopType)
                     doContinue = mainFunc(False, False, loopDir, options)
                 sys.stdout.flush()
         except:
             traceback.print_exc(file=sys.stdout)
             print("Loop terminated unexpectedly.")
-            psmMessage = "&st=0&stDes=Loop terminated unexpectedly."
-            sendMessageToPsm(psmMessage, loopType)
+            sendMessageToPsm(0, "Loop terminated unexpectedly.", loopType)
     
         print("""\
 *****************************************************************************
@@ -172,21 +198,54 @@ End time:   %s
         else:
             print("End time reached, exiting.")
 
-def sendMessageToPsm(messageString, loopType):
+_PSM_QUEUE = None # urls to send to the PSM, see sendMessageToPsm
+_PSM_DRAIN_SECONDS = 15 # maximum time to wait for the delivery of pending PSM messages on exit
+
+def _psmWorker(timeout):
+    while True:
+        urlstring = _PSM_QUEUE.get()
+        try:
+            urllib.request.urlopen(urlstring, timeout=timeout).close()
+        except:
+            print("Problem output to PSM:")
+            traceback.print_exc(file=sys.stdout)
+        _PSM_QUEUE.task_done()
+
+def _drainPsmQueue(timeout=_PSM_DRAIN_SECONDS):
+    """Waits until the queued PSM messages are sent but at most timeout seconds"""
+    if _PSM_QUEUE is None:
+        return
+    deadline = time.monotonic() + timeout
+    with _PSM_QUEUE.all_tasks_done:
+        while _PSM_QUEUE.unfinished_tasks:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                print("Warning! %s messages to the PSM were not delivered." % _PSM_QUEUE.unfinished_tasks,
+                      file=sys.stderr)
+                return
+            _PSM_QUEUE.all_tasks_done.wait(remaining)
+
+def sendMessageToPsm(state, description, loopType):
+    """Queues the message for the PSM. The messages are sent in order by
+    a background thread so the loop is not delayed by the PSM."""
+    global _PSM_QUEUE
     if loopType != "checkdata":
         timestring = str(int(float(time.time()) * 1000)) 
         psmPid = setting.getPsmOption("pid" + loopType)
         psmHttp = setting.getPsmOption("http" + loopType)
         if psmHttp != "":
             print("   PSM   ", psmHttp)
-            urlstring = "http://" + psmHttp + "/PSM/SetProcessState.jsp?pid=" + psmPid
-            urlstring += messageString.replace(" ", "%20")
-            urlstring += "&ts=" + timestring
-            try:
-                urllib.request.urlopen(urlstring)
-            except:
-                print("Problem output to PSM:")
-                traceback.print_exc(file=sys.stdout)
+            urlstring = "http://" + psmHttp + "/PSM/SetProcessState.jsp?" + urllib.parse.urlencode(
+                    (("pid", psmPid), ("st", state), ("stDes", description), ("ts", timestring)),
+                    quote_via=urllib.parse.quote)
+            if _PSM_QUEUE is None:
+                _PSM_QUEUE = queue.Queue()
+                timeout = setting.getPsmOption("timeout")
+                threading.Thread(target=_psmWorker, args=(float(timeout) if timeout else _PSM_TIMEOUT,),
+                                 daemon=True).start()
+                # deliver the pending messages (e.g. loop termination) before exiting
+                atexit.register(_drainPsmQueue)
+            _PSM_QUEUE.put(urlstring)
 
 def main(dbSchema, loopDir):
     """
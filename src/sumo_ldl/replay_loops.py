@@ -22,6 +22,8 @@ import optparse
 from . import tools
 
 THIS_DIR = os.path.dirname(__file__)
+_READ_SIZE = 1 << 16
+_PENDING = {} # pid -> output read after the last keyword line
 
 
 def import_from_file(module_file):
@@ -36,20 +38,47 @@ def get_options(args):
     optParser.add_option("-r", "--region", help="REGION to use for both loops")
     optParser.add_option("-c", "--confFile", help="config file for loops")
     optParser.add_option("-l", "--log", help="write log to FILE", metavar="FILE")
+    optParser.add_option("--use-signals", default=False, action="store_true",
+                         help="alternate the loops with SIGSTOP/SIGCONT instead of the stdin step barrier")
     (options, args) = optParser.parse_args(args=args)
     return options
 
+def _echo(data):
+    if data:
+        sys.stdout.write(data.decode(errors="replace"))
+        sys.stdout.flush()
+
 def read_until(process, keyword):
-    line = "dummy"
+    """Passes the output of the process to stdout until a line containing the
+    keyword is complete and returns this line. Returns None if the process
+    output ends before. The output is read in large chunks, the part after the
+    keyword line is kept for the next call."""
     if process is None:
         return None
-    while process.poll() is None and line is not None:
-        line = process.stdout.readline()
-        sys.stdout.write(line)
-        sys.stdout.flush()
-        if keyword in line:
-            return line
-    return None
+    keyword = keyword.encode()
+    fd = process.stdout.fileno()
+    buf = _PENDING.pop(process.pid, b"")
+    while True:
+        pos = buf.find(keyword)
+        if pos >= 0:
+            end = buf.find(b"\n", pos) + 1
+            if end > 0:
+                _echo(buf[:end])
+                _PENDING[process.pid] = buf[end:]
+                return buf[buf.rfind(b"\n", 0, pos) + 1:end].decode(errors="replace")
+        else:
+            # pass complete lines through, the keyword may span the chunk border
+            lineEnd = buf.rfind(b"\n") + 1
+            _echo(buf[:lineEnd])
+            buf = buf[lineEnd:]
+        chunk = os.read(fd, _READ_SIZE)
+        if not chunk:
+            _echo(buf)
+            pos = buf.find(keyword)
+            if pos >= 0:
+                return buf[buf.rfind(b"\n", 0, pos) + 1:].decode(errors="replace")
+            return None
+        buf += chunk
 
 def stop(process):
     if process is not None:
@@ -65,6 +94,15 @@ def resume(process):
         except OSError:
             print("could not resume process %s. already finished" % process.pid)
 
+def release(process):
+    """lets a process started with --step-barrier run its next step"""
+    if process is not None:
+        try:
+            process.stdin.write(b"x")
+            process.stdin.flush()
+        except OSError:
+            print("could not release process %s. already finished" % process.pid)
+
 def main(args):
     options = get_options(args)
     dbSchema = import_from_file(options.schema)
@@ -74,33 +112,40 @@ def main(args):
     outf = open(os.path.join(THIS_DIR, os.path.normpath(options.log)), "w")
     sys.stdout = tools.TeeFile(sys.__stdout__, outf)
 
+    if options.use_signals:
+        barrier = []
+        hold, proceed = stop, resume
+    else:
+        barrier = ['--step-barrier']
+        hold, proceed = (lambda process: None), release
+
     detCmd = [sys.executable, options.schema,
                 '--region', options.region,
                 '--confFile', options.confFile,
-                '--type', 'detector']
+                '--type', 'detector'] + barrier
     detProcess = Popen(detCmd, stdout=PIPE, stdin=PIPE, stderr=STDOUT)
     print("started detector process %s." % detProcess.pid)
-    stop(detProcess)
+    hold(detProcess)
 
     simCmd = [sys.executable, options.schema,
                 '--region', options.region,
                 '--confFile', options.confFile,
-                '--type', 'simulation']
+                '--type', 'simulation'] + barrier
     simProcess = Popen(simCmd, stdout=PIPE, stdin=PIPE, stderr=STDOUT)
     print("started simulation process %s." % simProcess.pid)
-    stop(simProcess)
+    hold(simProcess)
 
     while detProcess and simProcess:
-        resume(detProcess)
+        proceed(detProcess)
         if read_until(detProcess, "Duration:") is None:
             print("detector process finished")
             detProcess = None
-        stop(detProcess)
-        resume(simProcess)
+        hold(detProcess)
+        proceed(simProcess)
         if read_until(simProcess, "Duration:") is None:
             print("simulation process finished")
             simProcess = None
-        stop(simProcess)
+        hold(simProcess)
 
     print("finished replaying loops")
 
@@ -16,6 +16,7 @@ edges in the network. Usually called by simulationRun.py.
 import os, shutil
 from datetime import datetime, timedelta
 import collections
+from functools import lru_cache
 
 from . import setting, tools, database
 from .setting import dbSchema
@@ -25,57 +26,75 @@ STATIC = set()
 DYNAMIC = set()
 INVALID = set()
 LAST_RESET = None
+NEXT_RESET = None # earliest time for the next daily reset
+REVERSE_EDGE_MAP = None # database edge id -> simulation edge id, refreshed on reset
 
 
 def checkReset(isFirst, time):
     """reset once per day but try to do it in the morning hours. Return whether
     a reset took place"""
-    global LAST_RESET
+    global LAST_RESET, NEXT_RESET
     if isFirst or (
-            LAST_RESET and 
-            time - LAST_RESET >= timedelta(days=1) and
+            NEXT_RESET is not None and
+            time >= NEXT_RESET and
             time.hour < 4):
         DYNAMIC.clear()
         INVALID.clear()
         LAST_RESET = time
+        NEXT_RESET = time + timedelta(days=1)
         return True
     else:
         return False
 
 
-def generateDynamic(file, isFirst, intervalBegin, intervalEnd, routeInterval):
-    qualityThreshold = int(setting.getLoopOption("qualityThreshold"))
-    typeName = setting.getLoopOption("calibrationSource")
-    reset = checkReset(isFirst, intervalBegin)
-    conn = database.createDatabaseConnection()
+@lru_cache(maxsize=None)
+def _dynamicQuery(typeName):
+    """Returns the query for the edges and qualities of the given traffic type.
+    The interval bounds are parameters."""
     intervalTable, dataTable, q_column, v_column = dbSchema.AggregateData.getSchema(typeName)
-    command = """SELECT edge_id, a.quality
+    return """SELECT edge_id, a.quality
                  FROM %s t, %s a
-                 WHERE a.%s = t.%s AND %s > '%s' AND %s <= '%s' AND %s IS NOT NULL %s
+                 WHERE a.%s = t.%s AND %s > %%s AND %s <= %%s AND %s IS NOT NULL %s
         """ % (intervalTable, dataTable,
             dbSchema.Tables.traffic.traffic_id,
             dbSchema.Tables.traffic.traffic_id,
-            dbSchema.Tables.traffic.traffic_time, intervalBegin,
-            dbSchema.Tables.traffic.traffic_time, intervalEnd,
+            dbSchema.Tables.traffic.traffic_time,
+            dbSchema.Tables.traffic.traffic_time,
             q_column,
             dbSchema.Extrapolation.getTypePredicate(typeName))
-    rows = database.execSQL(conn, command)
 
-    reverseEdgeMap = reversedMap(dbSchema.AggregateData.getSimulationEdgeMap(conn))
-    for edge_id, quality in rows:
+
+def generateDynamic(file, isFirst, intervalBegin, intervalEnd, routeInterval):
+    qualityThreshold = int(setting.getLoopOption("qualityThreshold"))
+    typeName = setting.getLoopOption("calibrationSource")
+    reset = checkReset(isFirst, intervalBegin)
+    conn = database.createDatabaseConnection()
+    global REVERSE_EDGE_MAP
+    if reset or REVERSE_EDGE_MAP is None:
+        REVERSE_EDGE_MAP = reversedMap(dbSchema.AggregateData.getSimulationEdgeMap(conn))
+    reverseEdgeMap = REVERSE_EDGE_MAP
+    edges = setting.edges
+    invalid = set()
+    valid = set()
+    for edge_id, quality in database.execSQLIter(conn, _dynamicQuery(typeName), "dynamic_route_rows",
+                                                   params=(intervalBegin, intervalEnd)):
         edge_id = reverseEdgeMap.get(edge_id, edge_id)
-        if edge_id in setting.edges:
+        if edge_id in edges:
             if reset and int(quality) < qualityThreshold:
-                INVALID.add(edge_id)
-            elif edge_id not in INVALID:
-                DYNAMIC.add(edge_id)
+                invalid.add(edge_id)
+            else:
+                valid.add(edge_id)
+    database.closeDatabaseConnection(conn)
+    INVALID.update(invalid)
+    DYNAMIC.update(valid.difference(INVALID))
     routeStart = tools.daySecond(tools.roundToMinute(intervalEnd - routeInterval, routeInterval, tools.ROUND_DOWN)) 
+    probeEnd = 'freq="%s" begin="%s" file="NUL"/>\n' % (routeInterval.seconds, routeStart)
+    parts = ['<?xml version="1.0"?>\n<add>\n']
+    for edge in DYNAMIC:
+        parts.append('    <routeProbe id="routedist_%s" edge="%s" %s' % (edge, edge, probeEnd))
+    parts.append('</add>\n')
     with open(file, 'w') as f:
-        print('<?xml version="1.0"?>\n<add>', file=f)
-        for edge in DYNAMIC:
-            print('    <routeProbe id="routedist_%s" edge="%s"' % (edge, edge), end=' ', file=f)
-            print('freq="%s" begin="%s" file="NUL"/>' % (routeInterval.seconds, routeStart), file=f) 
-        print('</add>', file=f)
+        f.write("".join(parts))
 
 
 def generateStatic(file, isFirst, intervalBegin, intervalEnd, edges, routeDir):
@@ -89,53 +108,58 @@ def generateStatic(file, isFirst, intervalBegin, intervalEnd, edges, routeDir):
     # get the mapping between FBD_ID and SUMO_ID
     conn = database.createDatabaseConnection()
     edgeMap = dbSchema.AggregateData.getSimulationEdgeMap(conn, True)  # sumo_id = [fbd_id...]
-    uncoveredFbd = set()
-    coveredFbd = set()
 
     # use route distribtuion from a existing edge, when more than one sumo edges are mapped to a fbd_id and one or more of the sumo edges have detectors.
     matchedMap = collections.defaultdict(list)
     missedEdges = set()
 
     # all edges will be generated, not only the new coming ones
-    with open(file, 'w') as distributions:
-        print('<?xml version="1.0"?>\n<routes>', file=distributions)
+    listings = {} # subdirectory of routeDir -> set of contained files
+    def getRouteFile(edge):
+        """returns the path of the route distribution file of the edge or None"""
+        if len(edge) <= 2:
+            return None
+        dirName = edge[1:3] if edge[0] == "-" else edge[:2]
+        if dirName not in listings:
+            try:
+                listings[dirName] = set(os.listdir(os.path.join(routeDir, dirName)))
+            except OSError:
+                listings[dirName] = set()
+        if edge in listings[dirName]:
+            return os.path.join(routeDir, dirName, edge)
+        return None
+
+    routeFiles = {} # edge -> route distribution file for all edges which have one
+    with open(file, 'wb', buffering=1 << 20) as distributions:
+        distributions.write(b'<?xml version="1.0"?>\n<routes>\n')
         for edge in edges:
-            dirName = ""
-            if len(edge) > 2:
-                dirName = edge[:2]
-                if edge[0] == "-":
-                    dirName = edge[1:3]
-                if os.path.exists(os.path.join(routeDir,dirName,edge)):
-                    f = open(os.path.join(routeDir,dirName,edge))
-                    shutil.copyfileobj(f, distributions)
-                    f.close()
-                    coveredFbd.update(edgeMap[edge])
-                    for fid in edgeMap[edge]:
-                        matchedMap[fid].append(edge)
-                else:
-                    uncoveredFbd.update(edgeMap[edge])
-                    missedEdges.add(edge)
+            routeFile = getRouteFile(edge)
+            if routeFile is not None:
+                routeFiles[edge] = routeFile
+                with open(routeFile, 'rb') as f:
+                    shutil.copyfileobj(f, distributions, 1 << 20)
+                for fid in edgeMap[edge]:
+                    matchedMap[fid].append(edge)
+            elif len(edge) > 2:
+                missedEdges.add(edge)
         for me in missedEdges:
             # get the reference edge
             findRefEdge = True
             for fid in edgeMap[me]:
-                if matchedMap[fid]:
+                if fid in matchedMap:
                     edge = matchedMap[fid][0] # use the route distribution of the first edge
-                    if len(edge) > 2 and findRefEdge:
-                        dirName = edge[:2]
-                        if edge[0] == "-":
-                            dirName = edge[1:3]
-                        if os.path.exists(os.path.join(routeDir,dirName,edge)):
-                            f = open(os.path.join(routeDir,dirName,edge))
-                            for line in f:
-                                elems = line.split('"')
-                                print('%s"routedist_%s"%s"%s"%s"%s"%s\n' %(elems[0],me,elems[2],elems[3],elems[4],elems[5],elems[6]), file=distributions)
-                            f.close()
-                        findRefEdge = False
+                    routeDist = b'"routedist_%s"' % me.encode()
+                    with open(routeFiles[edge], 'rb') as f:
+                        for line in f:
+                            elems = line.split(b'"')
+                            distributions.write(b'%s%s%s"%s"%s"%s"%s\n\n' % (
+                                elems[0], routeDist, elems[2], elems[3], elems[4], elems[5], elems[6]))
+                    findRefEdge = False
+                    break
             if findRefEdge:
                 print('Warning: no existing route distribtuion file sutiable for', me)
-        print('</routes>', file=distributions)
+        distributions.write(b'</routes>\n')
     # check if any fbd_id that has detectors has no corresponding edge file containing route distribution
-    uncoveredFbd.difference_update(coveredFbd)
+    uncoveredFbd = set([fid for me in missedEdges for fid in edgeMap[me] if fid not in matchedMap])
     if uncoveredFbd:
         print('Warning: the file for edges', uncoveredFbd, 'does not exist.')
@@ -14,6 +14,7 @@ Configuration interface for the Delphi simulation setup.
 import os,sys
 from configparser import ConfigParser, NoOptionError
 from datetime import datetime, timedelta
+from functools import lru_cache
 
 THIS_DIR = os.path.dirname(__file__)
 _CONFIG = ConfigParser({"starttime": datetime.now().strftime("%Y-%m-%d %H:%M")})
@@ -23,7 +24,7 @@ startTime = None
 endTime = None
 timeline = None
 scenarioID = None
-databaseTime = timedelta(0)
+databaseTime = 0. # seconds spent in database calls during the current step
 step = 1
 errorOnLastRun = False
 lastCleanup = datetime.min
@@ -42,25 +43,37 @@ def init(schema, filename="delphi.cfg"):
     configFile = open(filename)
     loopDir = os.path.dirname(configFile.name)
     _CONFIG.read_file(configFile)
+    _invalidate()
 
+def _invalidate():
+    """clears the caches of the parsed option values after the config changed"""
+    for getter in (_checkSubOption, hasOption, getOption, getOptionBool, getOptionMinute, getOptionInt, _getOptionFloat):
+        getter.cache_clear()
+
+@lru_cache(maxsize=None)
 def _checkSubOption(section, option):
+    """returns the region specific name of the option if it exists, the option itself otherwise"""
     if _CONFIG.has_option("Loop", "region"):
         subOption = option + "." + _CONFIG.get("Loop", "region")
         if _CONFIG.has_option(section, subOption):
             return subOption
     return option
 
+@lru_cache(maxsize=None)
 def hasOption(section, option):
     return _CONFIG.has_option(section, _checkSubOption(section, option))
 
+@lru_cache(maxsize=None)
 def getOption(section, option):
     if not hasOption(section, option):
         return ""
     return _CONFIG.get(section, _checkSubOption(section, option))
 
+@lru_cache(maxsize=None)
 def getOptionBool(section, option):
     return _CONFIG.getboolean(section, _checkSubOption(section, option))
 
+@lru_cache(maxsize=None)
 def getOptionMinute(section, option):
     return timedelta(minutes=_getOptionFloat(section, option))
 
@@ -75,9 +88,11 @@ def getOptionDate(section, option, override=None):
         return datetime.now() - delta
     return datetime.strptime(date, "%Y-%m-%d %H:%M")
 
+@lru_cache(maxsize=None)
 def getOptionInt(section, option):
     return _CONFIG.getint(section, _checkSubOption(section, option))
 
+@lru_cache(maxsize=None)
 def _getOptionFloat(section, option):
     return _CONFIG.getfloat(section, _checkSubOption(section, option))
 
@@ -96,6 +111,7 @@ def setRegion(region):
     if not _CONFIG.has_section("Loop"):
         _CONFIG.add_section("Loop")
     _CONFIG.set("Loop", "region", region)
+    _invalidate()
 
 def getLoopOption(option):
     return getOption("Loop", option)
@@ -104,7 +120,7 @@ def getLoopOptionMinutes(option):
     return getOptionMinute("Loop", option)
 
 def getLoopOptionBool(option):
-    return _CONFIG.getboolean("Loop", _checkSubOption("Loop", option))
+    return getOptionBool("Loop", option)
 
 def getLoopOptionList(option):
     option = _checkSubOption("Loop", option)
@@ -114,7 +130,7 @@ def getOSDependentLoopOptionPath(option):
     try:
         optionValue = _CONFIG.get("Loop", _checkSubOption("Loop", option + "." + os.name))
     except NoOptionError:
-        optionValue = _CONFIG.get("Loop", _checkSubOption("Loop"))
+        optionValue = _CONFIG.get("Loop", _checkSubOption("Loop", option))
     return os.path.join(loopDir, optionValue)
 
 def getLoopOptionPathList(option):
@@ -12,8 +12,9 @@
 Executes one simulation run including input generation and output parsing.
 Usually it is called from loop.py.
 """
-import os, sys, shutil, glob, pickle, subprocess, re
+import os, sys, shutil, glob, shlex, subprocess
 from datetime import datetime, timedelta
+from functools import lru_cache
 
 from . import generateSimulationInput, generateViewerInput, routeDistributions, aggregateData, generateEmissionOutput
 from . import setting, tools, database
@@ -24,10 +25,10 @@ from .step import systemStep, pythonStep
 STATE_FILE = "state.xml.gz"
 
 def buildDirs(root, currTime, timeformat, repeat):
-    simDir = os.path.join(root, "sim", currTime.strftime(timeformat))
-    statefile = os.path.join(root, "sim", (currTime-repeat).strftime(timeformat), STATE_FILE)
-    if not os.path.exists(simDir):
-        os.makedirs(simDir)
+    simRoot = os.path.join(root, "sim")
+    simDir = os.path.join(simRoot, currTime.strftime(timeformat))
+    statefile = os.path.join(simRoot, (currTime-repeat).strftime(timeformat), STATE_FILE)
+    os.makedirs(simDir, exist_ok=True)
     return simDir, statefile
 
 def onRemovalError(func, path, exc_info):
@@ -35,61 +36,90 @@ def onRemovalError(func, path, exc_info):
     print(exc_info[1], file=sys.stderr)
 
 def diskAvailable(path):
-    if os.name == "posix":
-        stats = os.statvfs(path)
-        return stats.f_bsize * stats.f_bavail
-    if os.name == "nt":
-        output = subprocess.Popen(["dir", path], stdout=subprocess.PIPE, shell=True).communicate()[0]
-        bytes = re.findall('([0-9.,]*) [Bb]ytes', output.splitlines()[-1])[0]
-        return int(re.sub("[,.]", "", bytes))
+    return shutil.disk_usage(path).free
+
+@lru_cache(maxsize=16)
+def _listDir(directory, mtime):
+    """returns the set of file paths in directory, mtime invalidates the cached listing"""
+    return frozenset(os.path.join(directory, name) for name in os.listdir(directory))
+
+def _existingFiles(directory):
+    """returns the set of file paths in directory, empty if it does not exist"""
+    try:
+        return _listDir(directory, os.stat(directory).st_mtime)
+    except OSError:
+        return frozenset()
+
+def _linkOrCopy(src, dst):
+    """hard links src to dst if both are on the same file system, copies otherwise"""
+    tmp = "%s.%s.tmp" % (dst, os.getpid())
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
 
 def copyBackupClean(root, currTime, simOutputDir):
     mdate = currTime.strftime("_%Y%m%d_%H%M00")
-    for targetDir in getLoopOptionPathList("viewerData"):
-        if not os.path.exists(targetDir):
-            os.makedirs(targetDir)
+    viewerDirs = getLoopOptionPathList("viewerData")
+    for targetDir in viewerDirs:
+        os.makedirs(targetDir, exist_ok=True)
         print("locking", targetDir, 'TEXTTEST_IGNORE')
-        lock = open(os.path.join(targetDir, "lock.txt"), 'w')
-        print(currTime, 'TEXTTEST_IGNORE', file=lock)
-        lock.close()
+        lockFile = os.path.join(targetDir, "lock.txt")
+        with open(lockFile, 'w') as lock:
+            print(currTime, 'TEXTTEST_IGNORE', file=lock)
         for f in ["simulation", "prediction", "compare"]:
             filepath = os.path.join(simOutputDir, f + ".txt")
             if os.path.exists(filepath):
                 print("copy", f, targetDir, 'TEXTTEST_IGNORE')
-                shutil.copyfile(filepath, os.path.join(targetDir, f + mdate + ".txt"))
+                _linkOrCopy(filepath, os.path.join(targetDir, f + mdate + ".txt"))
         print("unlocking", targetDir, 'TEXTTEST_IGNORE')
-        os.remove(os.path.join(targetDir, "lock.txt"))
+        os.remove(lockFile)
     # delete all files beyond the specified age
-    for deldir in ["sim"] + getLoopOptionPathList("viewerData"):
-        for f in sorted(glob.glob(os.path.join(root, deldir, "*"))):
-            if datetime.fromtimestamp(os.path.getmtime(f)) < setting.startTime - getLoopOptionMinutes("deleteafter"):
-                shutil.rmtree(f, onerror=onRemovalError)
+    deleteBefore = (setting.startTime - getLoopOptionMinutes("deleteafter")).timestamp()
+    for deldir in ["sim"] + viewerDirs:
+        deldir = os.path.join(root, deldir)
+        if not os.path.isdir(deldir):
+            continue
+        with os.scandir(deldir) as entries:
+            old = [e.path for e in entries if not e.name.startswith(".") and e.stat().st_mtime < deleteBefore]
+        for f in sorted(old):
+            shutil.rmtree(f, onerror=onRemovalError)
     # delete big files to maintain minimum free disk space
     MIN_FREE_BYTES = 10 * 2**30 # 10GB
-    for f in sorted(glob.glob(os.path.join(root, "sim_outputs", "*", STATE_FILE))):
-        if diskAvailable(f) < MIN_FREE_BYTES:
+    deficit = MIN_FREE_BYTES - diskAvailable(root)
+    if deficit > 0:
+        # collect the oldest state files until their size covers the deficit
+        toDelete = []
+        for f in sorted(glob.glob(os.path.join(root, "sim_outputs", "*", STATE_FILE))):
+            if deficit <= 0:
+                break
+            try:
+                deficit -= os.path.getsize(f)
+            except OSError:
+                continue
+            toDelete.append(f)
+        for f in toDelete:
             try:
                 os.remove(f)
             except:
                 print("Warning! Could not remove %s." % f, file=sys.stderr)
                 print(sys.exc_info(), file=sys.stderr)
-        else:
-            break
 
 
 def prepare_dump_helper(type, i, aggregation, finalTime, simbegSec, simOutputDir, 
-                        fd, dumpfile, dumpInterpretation,
+                        parts, dumpfile, dumpInterpretation,
                         emissionInterpretation=None, emissionfile=None, emissionNormed=True,
                         withInternal=False):
-    """writes to dumpAdd fd and adds entry to dumpInterpretation"""
+    """appends the dumpAdd lines to parts and adds entry to dumpInterpretation"""
     end = finalTime - i * aggregation
     beg = end - aggregation
     endSec = tools.daySecond(end, simbegSec)
     begSec = tools.daySecond(beg, simbegSec)
     id = '%s%s' % (type, i)
     file = (os.path.join(simOutputDir, '%s.txt' % type) if i == 0 else None)
-    print('    <edgeData id="%s" begin="%s" end="%s" file="%s" excludeEmpty="modified" withInternal="%s" writeAttributes="speed departed entered vaporized"/>' % (   # only for huainan todo: check with the simulation performance if data from the internal links should be used.
-            id, begSec, endSec, dumpfile, withInternal), file=fd)
+    parts.append('    <edgeData id="%s" begin="%s" end="%s" file="%s" excludeEmpty="modified" withInternal="%s" writeAttributes="speed departed entered vaporized"/>\n' % (   # only for huainan todo: check with the simulation performance if data from the internal links should be used.
+            id, begSec, endSec, dumpfile, withInternal))
     dumpInterpretation[id] = (end, type, file)
     if emissionfile:
         file = (os.path.join(simOutputDir, 'emission_%s.txt' % type) if i == 0 else None)
@@ -97,8 +127,8 @@ def prepare_dump_helper(type, i, aggregation, finalTime, simbegSec, simOutputDir
             attributes = ["%s_normed" % e for e in ('CO', 'CO2', 'HC', 'PMx', 'NOx', 'fuel', 'electricity')]
         else:
             attributes = ["%s_abs" % e for e in ('CO', 'CO2', 'HC', 'PMx', 'NOx', 'fuel', 'electricity')]
-        print('    <edgeData id="%s" begin="%s" end="%s" file="%s" type="emissions" excludeEmpty="modified" withInternal="%s" writeAttributes="%s"/>' % (
-                id, begSec, endSec, emissionfile, withInternal, " ".join(attributes)), file=fd)
+        parts.append('    <edgeData id="%s" begin="%s" end="%s" file="%s" type="emissions" excludeEmpty="modified" withInternal="%s" writeAttributes="%s"/>\n' % (
+                id, begSec, endSec, emissionfile, withInternal, " ".join(attributes)))
         emissionInterpretation[id] = (end, type, file)
     
 
@@ -118,13 +148,14 @@ def prepare_dump(simDir, simbegSec, startTime, simEnd, aggregation, repeat, fore
         emissionInterpretation = {}   # edgeDataID -> (intervalEnd, traffic_type, fileName|None)
         emissionfile = os.path.abspath(os.path.join(simDir, 'emission_%s_%s.csv.gz' % (
             startTime.strftime("%H-%M"), aggregation.seconds))) 
+    parts = ["<a>\n"]
+    for i in range(numDumpsSimulation):
+        prepare_dump_helper('simulation', i, aggregation, startTime, simbegSec, simDir, parts, dumpfile, dumpInterpretation, emissionInterpretation, emissionfile, True, withInternal)
+    for i in range(numDumpsPrediction):
+        prepare_dump_helper('prediction', i, aggregation, simEnd, simbegSec, simDir, parts, dumpfile, dumpInterpretation, emissionInterpretation, emissionfile, True, withInternal)
+    parts.append("</a>\n")
     with open(os.path.join(simDir, dumpAdd), "w") as fd:
-        print("<a>", file=fd)
-        for i in range(numDumpsSimulation):
-            prepare_dump_helper('simulation', i, aggregation, startTime, simbegSec, simDir, fd, dumpfile, dumpInterpretation, emissionInterpretation, emissionfile, True, withInternal)
-        for i in range(numDumpsPrediction):
-            prepare_dump_helper('prediction', i, aggregation, simEnd, simbegSec, simDir, fd, dumpfile, dumpInterpretation, emissionInterpretation, emissionfile, True, withInternal)
-        print("</a>", file=fd)
+        fd.write("".join(parts))
     return dumpAdd, dumpfile, dumpInterpretation, emissionfile, emissionInterpretation
 
 
@@ -141,15 +172,18 @@ def main(doStartEmpty, beginNewDay, loopDir, options):
     root = os.path.abspath(os.path.join(loopDir, region))
     repeat = getLoopOptionMinutes("repeat")
     aggregation = getLoopOptionMinutes("aggregate")
+    overlap = getLoopOptionMinutes("overlap")
+    forecast = getLoopOptionMinutes("forecast")
     if doStartEmpty:
-        if getLoopOptionMinutes("prefirst") < getLoopOptionMinutes("overlap"):
+        prefirst = getLoopOptionMinutes("prefirst")
+        if prefirst < overlap:
             print("Warning! The first simulation run should have a larger advance.")
-        simBegin = setting.startTime - getLoopOptionMinutes("prefirst")
+        simBegin = setting.startTime - prefirst
     else:
-        simBegin = setting.startTime - getLoopOptionMinutes("overlap")
-    saveStateTime = setting.startTime - getLoopOptionMinutes("overlap") + repeat
+        simBegin = setting.startTime - overlap
+    saveStateTime = setting.startTime - overlap + repeat
     forecastStart = setting.startTime
-    simEnd = forecastStart + getLoopOptionMinutes("forecast")
+    simEnd = forecastStart + forecast
     if saveStateTime < simBegin or saveStateTime >= simEnd:
         print("Error! Either your forecast or your prefirst setting are too small for the repeat.")
         return False
@@ -170,11 +204,10 @@ Simulating %s to %s,
     simbegSec = tools.daySecond(simBegin) 
     setting.step = 1
     if scenario:
-        conn = database.createDatabaseConnection()
-        rows = database.execSQL(conn, "SELECT scenario_id FROM scenario WHERE scenario_name='%s'" % scenario)
+        rows = database.execSQL(database.getConnection(),
+                                "SELECT scenario_id FROM scenario WHERE scenario_name='%s'" % scenario)
         if rows:
             setting.scenarioID = rows[0][0]
-        conn.close()
     resultDirs = pythonStep("Building directories", buildDirs,
                             (os.path.join(root, scenario), setting.startTime, "%Y_%m_%d_%H-%M-%S", repeat))
     if resultDirs is None:
@@ -182,9 +215,7 @@ Simulating %s to %s,
         return False
     simDir, statefile = resultDirs
     if not setting.edges:
-        edgePkl = open(os.path.join(root, "infra", "edges.pkl"), 'rb')
-        setting.edges = pickle.load(edgePkl)
-        edgePkl.close()
+        setting.edges = tools.loadEdges(os.path.join(root, "infra"))
 
     resultGenerateCalibrators = pythonStep("Generating calibrator input",
                       generateSimulationInput.generateCalibrators,
@@ -232,7 +263,7 @@ Simulating %s to %s,
     
     dumpAdd, dumpfile, dumpInterpretation, emissionfile, emissionInterpretation = prepare_dump(simDir,
             simbegSec, setting.startTime, simEnd, aggregation, repeat,
-            getLoopOptionMinutes("forecast"), emissionOutput, withInternal)
+            forecast, emissionOutput, withInternal)
     adds.append(dumpAdd)
     routes = []
     routeBegin = tools.roundToMinute(simBegin, routeStep, tools.ROUND_DOWN)
@@ -244,31 +275,30 @@ Simulating %s to %s,
             #dayPrefix = routesPrefix[routeTime.weekday()]
         #fileName = "%s%s.rou.xml" % (dayPrefix, tools.daySecond(routeTime)+dayOffset)
         fileName = "%s%s.rou.xml" % (routesPrefix[routeTime.weekday()], tools.daySecond(routeTime)+dayOffset)
-        if os.path.exists(fileName):
+        if fileName in _existingFiles(os.path.dirname(fileName)):
             routes.append(fileName)
         routeTime += routeStep
         if tools.daySecond(routeTime) == 0:
             dayOffset = 86400
 
-    fd = open(os.path.join(simDir, 'sumo.sumocfg'), "w")
-    print("""<configuration>
+    parts = ["""<configuration>
     <input>
         <net-file value="%s"/>
         <route-files value="%s"/>
-        <additional-files value="%s"/>""" % (getLoopOptionPathList("net")[0],
-                                             ",".join(routes), ",".join(adds)), file=fd)
+        <additional-files value="%s"/>\n""" % (getLoopOptionPathList("net")[0],
+                                             ",".join(routes), ",".join(adds))]
     if not doStartEmpty:
-        print('<load-state value="%s"/>' % statefile, file=fd)
+        parts.append('<load-state value="%s"/>\n' % statefile)
         if simbegSec==0:
-            print('<load-state.offset value="86400"/>', file=fd)
-    print("""    </input>
+            parts.append('<load-state.offset value="86400"/>\n')
+    parts.append("""    </input>
     <output>
         <save-state.files value="%s"/>
         <save-state.times value="%s"/>
-    </output>""" % (os.path.join(simDir, STATE_FILE),
-                    tools.daySecond(saveStateTime, simbegSec)), file=fd)
+    </output>\n""" % (os.path.join(simDir, STATE_FILE),
+                    tools.daySecond(saveStateTime, simbegSec)))
 
-    print("""    <time>
+    parts.append("""    <time>
         <begin value="%s"/>
         <end value="%s"/>
     </time>
@@ -280,11 +310,13 @@ Simulating %s to %s,
         <verbose value="true"/>
         <xml-validation value="never"/>
     </report>
-</configuration>""" % (simbegSec, tools.daySecond(simEnd, simbegSec)), file=fd)
-    fd.close()
+</configuration>\n""" % (simbegSec, tools.daySecond(simEnd, simbegSec)))
     sumoCfg = os.path.join(simDir, 'sumo.sumocfg')
-    subprocess.call([getOSDependentLoopOptionPath("sumobinary"), '-c', fd.name, '-C', sumoCfg, '--save-configuration.relative'] + getLoopOption("sumoOptions").split())
-    command = getOSDependentLoopOptionPath("sumobinary") + ' -c ' + sumoCfg
+    with open(sumoCfg, "w") as fd:
+        fd.write("".join(parts))
+    sumoBinary = getOSDependentLoopOptionPath("sumobinary")
+    subprocess.call([sumoBinary, '-c', fd.name, '-C', sumoCfg, '--save-configuration.relative'] + shlex.split(getLoopOption("sumoOptions"), posix=(os.name != "nt")))
+    command = [sumoBinary, '-c', sumoCfg]
     systemStep("Performing the simulation", command, simDir, currTimeMin)
 
     if os.path.exists(dumpfile):
@@ -305,8 +337,9 @@ Simulating %s to %s,
         pythonStep("Copying results, making backups",
                    copyBackupClean, (root, setting.startTime, simDir), simDir, currTimeMin)
         if getOptionInt("Loop", "deleteafterDB") > 0:
-            if setting.startTime - setting.lastCleanup > getLoopOptionMinutes("deleteafterDB"):
-                before = setting.startTime - getLoopOptionMinutes("deleteafterDB")
+            deleteAfterDB = getLoopOptionMinutes("deleteafterDB")
+            if setting.startTime - setting.lastCleanup > deleteAfterDB:
+                before = setting.startTime - deleteAfterDB
                 pythonStep("Cleaning database",
                            aggregateData.cleanUp, (before, ["simulation", "prediction"]), simDir, currTimeMin)
                 if getLoopOptionBool("emissionOutput"):
@@ -11,105 +11,106 @@
 """
 Helper functions for single steps in detector and simulation loop.
 """
-import os, sys, tempfile, traceback
+import os, io, re, sys, subprocess, traceback
 from datetime import datetime, timedelta
 
 from . import setting, tools, database
 from .setting import dbSchema
 
-def _checkOutput(lastTime, stdoutFile=None, stderrFile=None):
-    """Parses the output files of a step for warnings etc. and outputs the total time."""
+# keywords which classify the output of a step, matched in a single pass over the lower case output
+_LOG_SCAN = re.compile(rb'error|exception|warning|ok|simulation ended at time')
+_LOG_CLASS = {b"error": "error", b"exception": "error", b"warning": "warning",
+              b"ok": "ok", b"simulation ended at time": "ok"}
+
+def _checkOutput(lastTime, stdoutFile=None, stderrFile=None, stderrText=None):
+    """Parses the output files (or the captured stderr text) of a step for warnings etc.
+    and outputs the total time."""
     print("step#%s" % setting.step, end=' ')
-    errorCount = 0
-    warningCount = 0
-    sizeSum = 0
-    hadOK = False
+    counts = {"error": 0, "warning": 0, "ok": 0}
+    outputs = []
     for outFile in [stdoutFile, stderrFile]:
         if outFile:
-            sizeSum += os.path.getsize(outFile)
-            for line in open(outFile):
-                line = line.lower()
-                if line.find("error") > -1 or line.find("exception") > -1:
-                    errorCount += 1
-                if line.find("warning") > -1:
-                    warningCount += 1
-                if line.find("ok") > -1 or line.find("simulation ended at time") > -1:
-                    hadOK = True
-    if errorCount > 0:
+            with open(outFile, 'rb') as f:
+                outputs.append(f.read())
+    if stderrText is not None:
+        outputs.append(stderrText.encode("utf8"))
+    stderrSize = len(outputs[-1]) if stderrFile or stderrText is not None else 0
+    sizeSum = 0
+    for data in outputs:
+        sizeSum += len(data)
+        # scan the whole output at once, only the presence of the keywords matters
+        for match in _LOG_SCAN.finditer(data.lower()):
+            counts[_LOG_CLASS[match.group()]] += 1
+    if counts["error"] > 0:
         print("had errors,")
-    elif warningCount > 0:
+    elif counts["warning"] > 0:
         print("had warnings,")
-    elif stderrFile and os.path.getsize(stderrFile) > 0:
+    elif stderrSize > 0:
         print("had non-empty stderr,")
-    elif hadOK or sizeSum == 0:
+    elif counts["ok"] > 0 or sizeSum == 0:
         print("ok,")
     else:
         print("unknown status,")
     totalTime = datetime.now() - lastTime
-    print("...needed %s (%s)" % (totalTime, setting.databaseTime), 'TEXTTEST_IGNORE')
-    setting.databaseTime = timedelta(0)
+    print("...needed %s (%s)" % (totalTime, timedelta(seconds=setting.databaseTime)), 'TEXTTEST_IGNORE')
+    setting.databaseTime = 0.
     setting.step += 1
     print("- " * 39)
 
 def systemStep(comment, command, checkDir, suffix):
-    """Executes a step which involves an os.system call."""
+    """Executes a step which involves calling an external program.
+    The command is given as a list of the executable and its arguments."""
     lastTime = datetime.now()
-    exe = os.path.basename(command.split()[0])
+    exe = os.path.basename(command[0])
     if exe.endswith(".exe"):
         exe = exe[:-4]
     checkOut = os.path.join(checkDir, "%02i%s_%s.txt" % (setting.step, exe, suffix))
     checkErr = os.path.join(checkDir, "%02i%sError_%s.txt" % (setting.step, exe, suffix))
     print("step#%s" % setting.step)
     print(" (%s)" % comment)
-    print(" Call:", command, 'TEXTTEST_IGNORE')
+    print(" Call:", subprocess.list2cmdline(command), 'TEXTTEST_IGNORE')
     print(" redirecting stdout to %s and stderr to %s" % (checkOut, checkErr), 'TEXTTEST_IGNORE')
-    os.system(command + " > %s 2> %s" % (checkOut, checkErr))
+    with open(checkOut, 'wb') as out, open(checkErr, 'wb') as err:
+        subprocess.run(command, stdout=out, stderr=err)
     _checkOutput(lastTime, checkOut, checkErr), 'TEXTTEST_IGNORE'
 
 def pythonStep(comment, function, args, checkDir=None, suffix=None):
-    """Executes a step which is a python function call."""
+    """Executes a step which is a python function call.
+    The stderr output is collected in memory and written to the check file
+    in checkDir only if there is any."""
     lastTime = datetime.now()
     print("step#%s" % setting.step)
     print(" (%s)" % comment)
     checkErr = None
-    temp = None
+    errBuffer = io.StringIO()
     if checkDir:
         checkErr = os.path.join(checkDir, "%02i%s_%s.txt" % (setting.step, function.__name__, suffix))
-        sys.stderr = open(checkErr, 'w')
+        sys.stderr = errBuffer
     else:
-        fd, checkErr = tempfile.mkstemp()
-        os.close(fd)
-        temp = open(checkErr, 'w')
-        sys.stderr = tools.TeeFile(sys.stdout, temp)
+        sys.stderr = tools.TeeFile(sys.stdout, errBuffer)
     result = None
     try:
         print(" Call: %s%s" % (function.__name__, args), 'TEXTTEST_IGNORE')
-        if not temp:
+        if checkErr:
             print(" redirecting stderr to %s" % checkErr, 'TEXTTEST_IGNORE')
         result = function(*args)
-        if temp:
-            temp.close()
-        else:
-            sys.stderr.close()
     except KeyboardInterrupt:
-        if temp:
-            print("Interrupted! Temporary output file left at %s." % checkErr)
-        else:
-            print("Interrupted!")
+        print("Interrupted!")
+        _restoreStderr(errBuffer, checkErr)
         raise
     except:
-        if temp:
-            print("Exception caught! Temporary output file left at %s." % checkErr)
-        else:
-            print("Exception caught!")
+        print("Exception caught!")
         traceback.print_exc()
         setting.errorOnLastRun = True
-    _checkOutput(lastTime, stderrFile=checkErr)
-    try:
-        if temp:
-            os.remove(temp.name)
-    except:
-        print("Error cleaning temp! Temporary output file left at %s." % checkErr)
-        traceback.print_exc()
-    sys.stderr = sys.__stderr__
+    _checkOutput(lastTime, stderrText=_restoreStderr(errBuffer, checkErr))
     return result
+
+def _restoreStderr(errBuffer, checkErr):
+    """Resets sys.stderr and writes the captured text to checkErr if it is not empty.
+    Returns the captured text."""
+    sys.stderr = sys.__stderr__
+    errText = errBuffer.getvalue()
+    if checkErr and errText:
+        with open(checkErr, 'w') as f:
+            f.write(errText)
+    return errText
@@ -15,8 +15,10 @@ import os
 import sys
 import math
 import time
+import pickle
 from datetime import timedelta
 import operator
+from functools import lru_cache
 
 class TeeFile:
     """A helper class which allows simultaneous writes to several files"""
@@ -27,11 +29,9 @@ class TeeFile:
         for fp in self.files:
             fp.write(txt)
     def flush(self):
-        """flushes all file contents to disc"""
+        """flushes all file contents to the operating system"""
         for fp in self.files:
             fp.flush()
-            if fp != sys.__stdout__:
-                os.fsync(fp)
 
 
 ROUND_UP = 1
@@ -47,10 +47,12 @@ def daySecond(time, begin=-1):
        If begin is given, the result is increment in steps of whole days until
        it is larger than the value of begin."""
     result = time.hour * 3600 + time.minute * 60 + time.second
-    while result < begin:
-        result += 24 * 3600
+    if result < begin:
+        # add the number of whole days needed to reach begin
+        result -= 24 * 3600 * ((result - begin) // (24 * 3600))
     return result
 
+@lru_cache(maxsize=1024)
 def roundToMinute(date, interval=timedelta(minutes=1), rounding=ROUND_HALF_UP):
     """Rounds the date to the next full minute or minute interval.
     Also works if interval is not integer minutes but assumes that it is a fraction
@@ -110,7 +112,7 @@ class Table:
     # class for storing table and column name strings
     def __init__(self, name, **columns):
         self.name = name
-        for attr, value in list(columns.items()):
+        for attr, value in columns.items():
             setattr(self, attr, value)
 
     def __str__(self):
@@ -134,9 +136,14 @@ def safeBinaryOperator(binaryOperator):
 
 SAFE_ADD = safeBinaryOperator(operator.add)
 SAFE_SUB = safeBinaryOperator(operator.sub)
-SAFE_MUL = safeBinaryOperator(operator.sub)
+SAFE_MUL = safeBinaryOperator(operator.mul)
 SAFE_DIV = safeBinaryOperator(operator.truediv)
 
 def reversedMap(map):
     """return reversed map assuming input is a bijection"""
-    return dict([(v,k) for k,v in list(map.items())])
+    return {v: k for k, v in map.items()}
+
+def loadEdges(infraDir):
+    """Returns the set of simulation edge ids stored in edges.pkl in infraDir."""
+    with open(os.path.join(infraDir, "edges.pkl"), 'rb', buffering=1<<20) as f:
+        return pickle.load(f)